@@ -0,0 +1,278 @@
+import datetime
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+from forecast_series import PRECIPITATION_CODES, ForecastSeries
+
+# Пороги предупреждений (можно переопределить через .env)
+ALERT_COLD_BELOW = float(os.getenv("ALERT_COLD_BELOW", "-10"))        # °C
+ALERT_HEAT_ABOVE = float(os.getenv("ALERT_HEAT_ABOVE", "30"))         # °C
+ALERT_WIND_ABOVE = float(os.getenv("ALERT_WIND_ABOVE", "10"))         # м/с
+ALERT_TEMP_DROP = float(os.getenv("ALERT_TEMP_DROP", "8"))            # °C
+ALERT_TEMP_DROP_HOURS = int(os.getenv("ALERT_TEMP_DROP_HOURS", "6"))  # за сколько часов
+ALERT_LOOKAHEAD_MINUTES = int(os.getenv("ALERT_LOOKAHEAD_MINUTES", "180"))
+
+# Планирование проверок: как часто OpenWeather выпускает новый прогноз и границы интервала перепроверки
+ALERT_FORECAST_UPDATE_INTERVAL = int(os.getenv("ALERT_FORECAST_UPDATE_INTERVAL", "10800"))  # секунд
+ALERT_MIN_RECHECK = int(os.getenv("ALERT_MIN_RECHECK", "300"))      # секунд
+ALERT_MAX_RECHECK = int(os.getenv("ALERT_MAX_RECHECK", "10800"))    # секунд
+
+FORECAST_STEP = 3 * 3600  # шаг прогноза OpenWeather, секунд
+
+
+class Alert(NamedTuple):
+    city: object  # ключ города из входного словаря (id OpenWeather или нормализованное имя)
+    kind: str
+    time: int     # epoch (UTC) первого интервала в окне правила, в котором оно сработало
+    since: int    # начало эпизода: первый интервал непрерывной серии сработавших интервалов прогноза
+    until: int    # конец эпизода: последний интервал этой серии
+
+
+class ForecastFrame:
+    """Прогнозы всех городов, склеенные в общие столбцы numpy; city[i] — номер города строки i."""
+
+    def __init__(self, series_by_city: dict):
+        self.keys = list(series_by_city)
+        series = [series_by_city[key] for key in self.keys]
+        lengths = np.array([len(s) for s in series], dtype=np.int64)
+        self.city = np.repeat(np.arange(len(series)), lengths)
+        self.times = self._column(series, "times", np.int64)
+        self.codes = self._column(series, "codes", np.uint16)
+        self.temps = self._column(series, "temps", np.float32)
+        self.winds = self._column(series, "winds", np.float32)
+
+    @staticmethod
+    def _column(series: list[ForecastSeries], name: str, dtype) -> np.ndarray:
+        parts = [np.asarray(getattr(s, name), dtype=dtype) for s in series if len(s)]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+
+class AlertRule:
+    """Правило: mask(frame) -> булев массив строк frame, где условие выполнено."""
+
+    def __init__(self, kind: str, min_lead_minutes: int = 0, max_lead_minutes: int = ALERT_LOOKAHEAD_MINUTES):
+        self.kind = kind
+        self.min_lead_minutes = min_lead_minutes
+        self.max_lead_minutes = max_lead_minutes
+
+    def mask(self, frame: ForecastFrame) -> np.ndarray:
+        raise NotImplementedError
+
+
+class ThresholdRule(AlertRule):
+    def __init__(self, kind: str, column: str, below: float | None = None, above: float | None = None, **kwargs):
+        super().__init__(kind, **kwargs)
+        self.column = column
+        self.below = below
+        self.above = above
+
+    def mask(self, frame: ForecastFrame) -> np.ndarray:
+        values = getattr(frame, self.column)
+        result = np.zeros(len(frame), dtype=bool)
+        if self.below is not None:
+            result |= values < self.below
+        if self.above is not None:
+            result |= values > self.above
+        return result
+
+
+class CodeRule(AlertRule):
+    def __init__(self, kind: str, codes, **kwargs):
+        super().__init__(kind, **kwargs)
+        self.codes = np.array(sorted(codes), dtype=np.uint16)
+
+    def mask(self, frame: ForecastFrame) -> np.ndarray:
+        return np.isin(frame.codes, self.codes)
+
+
+class TemperatureDropRule(AlertRule):
+    """Температура упала не меньше чем на drop градусов за hours часов (отмечается более поздний интервал)."""
+
+    def __init__(self, kind: str, drop: float, hours: int, **kwargs):
+        super().__init__(kind, **kwargs)
+        self.drop = drop
+        self.hours = hours
+
+    def mask(self, frame: ForecastFrame) -> np.ndarray:
+        result = np.zeros(len(frame), dtype=bool)
+        for shift in range(1, max(self.hours * 3600 // FORECAST_STEP, 1) + 1):
+            if shift >= len(frame):
+                break
+            same_city = frame.city[shift:] == frame.city[:-shift]
+            in_span = frame.times[shift:] - frame.times[:-shift] <= self.hours * 3600
+            dropped = frame.temps[:-shift] - frame.temps[shift:] >= self.drop
+            result[shift:] |= same_city & in_span & dropped
+        return result
+
+
+ALERT_RULES: list[AlertRule] = [
+    ThresholdRule("cold", "temps", below=ALERT_COLD_BELOW),
+    ThresholdRule("heat", "temps", above=ALERT_HEAT_ABOVE),
+    ThresholdRule("wind", "winds", above=ALERT_WIND_ABOVE),
+    # осадки — как и раньше, только в ближайший час
+    CodeRule("precipitation", PRECIPITATION_CODES, max_lead_minutes=60),
+    TemperatureDropRule("temp_drop", ALERT_TEMP_DROP, ALERT_TEMP_DROP_HOURS),
+]
+
+
+def _first_per_city(frame: ForecastFrame, mask: np.ndarray) -> list[tuple[int, int]]:
+    """(номер города, строка) самой ранней отмеченной строки каждого города."""
+    hits = np.flatnonzero(mask)
+    if not hits.size:
+        return []
+    # строки отсортированы по городу и времени, поэтому первая строка города — самая ранняя
+    cities, first = np.unique(frame.city[hits], return_index=True)
+    return list(zip(cities.tolist(), hits[first].tolist()))
+
+
+def _runs_per_city(frame: ForecastFrame, mask: np.ndarray) -> dict[int, list[tuple[int, int]]]:
+    """
+    Номер города -> непрерывные серии отмеченных интервалов [(начало, конец), ...]:
+    соседние интервалы серии отстоят друг от друга не больше чем на шаг прогноза.
+    """
+    runs: dict[int, list[list[int]]] = {}
+    for row in np.flatnonzero(mask).tolist():
+        city, ts = int(frame.city[row]), int(frame.times[row])
+        city_runs = runs.setdefault(city, [])
+        if city_runs and ts - city_runs[-1][1] <= FORECAST_STEP:
+            city_runs[-1][1] = ts
+        else:
+            city_runs.append([ts, ts])
+    return {city: [tuple(run) for run in city_runs] for city, city_runs in runs.items()}
+
+
+def _evaluate(frame: ForecastFrame, now_ts: float, rules: list[AlertRule] | None) -> tuple[list[Alert], dict, dict]:
+    """
+    Сработавшие сейчас предупреждения; эпизоды, которые ещё не прошли (ключ города -> {вид: [(начало, конец)]});
+    и, для каждого города, момент, когда ближайший уже известный по прогнозу подходящий интервал
+    войдёт в окно своего правила.
+    """
+    alerts = []
+    episodes: dict = {}
+    upcoming: dict = {}
+    if not len(frame):
+        return alerts, episodes, upcoming
+    for rule in rules if rules is not None else ALERT_RULES:
+        mask = rule.mask(frame)
+        window_end = now_ts + rule.max_lead_minutes * 60
+        in_window = (frame.times >= now_ts + rule.min_lead_minutes * 60) & (frame.times <= window_end)
+        # интервал прогноза описывает FORECAST_STEP секунд после своего времени: пока они не прошли, эпизод идёт
+        runs_by_city = _runs_per_city(frame, mask & (frame.times + FORECAST_STEP > now_ts))
+        for city, runs in runs_by_city.items():
+            episodes.setdefault(frame.keys[city], {})[rule.kind] = runs
+        for city, row in _first_per_city(frame, mask & in_window):
+            ts = int(frame.times[row])
+            since, until = next(run for run in runs_by_city[city] if run[0] <= ts <= run[1])
+            alerts.append(Alert(frame.keys[city], rule.kind, ts, since, until))
+        for city, row in _first_per_city(frame, mask & (frame.times > window_end)):
+            key = frame.keys[city]
+            enters_at = int(frame.times[row]) - rule.max_lead_minutes * 60
+            upcoming[key] = min(upcoming.get(key, enters_at), enters_at)
+    return alerts, episodes, upcoming
+
+
+class AlertPlanner:
+    """
+    Когда перепроверять город и о чём из найденного сообщать.
+
+    Город проверяется снова, как только может появиться что-то новое:
+    - OpenWeather выпустил новый прогноз (received_at + ALERT_FORECAST_UPDATE_INTERVAL);
+    - уже известный интервал с осадками/морозом/... входит в окно своего правила.
+    Но не реже ALERT_MAX_RECHECK и не чаще ALERT_MIN_RECHECK.
+
+    Предупреждение одного вида по городу — эпизод: непрерывная серия сработавших интервалов прогноза.
+    Эпизод помнится, пока он есть в прогнозе и его последний интервал не прошёл, даже если
+    сейчас в окно правила (у осадков — час) не попадает ни один интервал; повторно о нём не сообщается.
+    """
+
+    def __init__(self, rules: list[AlertRule] | None = None):
+        self._rules = rules
+        self._next_check: dict = {}
+        self._episodes: dict = {}  # ключ города -> {вид: (начало эпизода, конец эпизода)}
+
+    def __len__(self) -> int:
+        return len(self._next_check)
+
+    def due(self, city_keys, now_ts: float) -> list:
+        """Города из city_keys, которые пора проверить; города без подписчиков забываются."""
+        city_keys = set(city_keys)
+        for key in list(self._next_check):
+            if key not in city_keys:
+                del self._next_check[key]
+                self._episodes.pop(key, None)
+        return [key for key in city_keys if self._next_check.get(key, 0) <= now_ts]
+
+    def postpone(self, city_key, now_ts: float) -> None:
+        """Прогноз получить не удалось — попробуем через ALERT_MIN_RECHECK."""
+        self._next_check[city_key] = now_ts + ALERT_MIN_RECHECK
+
+    def retract(self, alerts: list[Alert], now_ts: float) -> None:
+        """Предупреждения не удалось отправить — забываем их эпизоды, чтобы сообщить о них при следующей проверке."""
+        for alert in alerts:
+            episodes = self._episodes.get(alert.city, {})
+            if episodes.get(alert.kind, (None,))[0] == alert.since:
+                del episodes[alert.kind]
+            self.postpone(alert.city, now_ts)
+
+    def evaluate(self, series_by_city: dict, now_ts: float) -> list[Alert]:
+        """Проверяет города и возвращает только предупреждения, начавшие новый эпизод."""
+        alerts, current, upcoming = _evaluate(ForecastFrame(series_by_city), now_ts, self._rules)
+        alerts_by_city: dict = {}
+        for alert in alerts:
+            alerts_by_city.setdefault(alert.city, []).append(alert)
+        new_alerts = []
+        for key, series in series_by_city.items():
+            # известный эпизод продолжается, если в прогнозе есть ещё не прошедшая серия, которая с ним смыкается
+            episodes = {}
+            runs_by_kind = current.get(key, {})
+            for kind, (since, until) in self._episodes.pop(key, {}).items():
+                for run_since, run_until in runs_by_kind.get(kind, ()):
+                    if run_since <= until + FORECAST_STEP and run_until + FORECAST_STEP >= since:
+                        episodes[kind] = (min(since, run_since), run_until)
+                        break
+            for alert in alerts_by_city.get(key, ()):
+                episode = episodes.get(alert.kind)
+                if episode is None or alert.time > episode[1]:
+                    episodes[alert.kind] = (alert.since, alert.until)
+                    new_alerts.append(alert)
+            if episodes:
+                self._episodes[key] = episodes
+
+            candidates = [series.received_at + ALERT_FORECAST_UPDATE_INTERVAL, now_ts + ALERT_MAX_RECHECK]
+            if key in upcoming:
+                candidates.append(upcoming[key])
+            self._next_check[key] = max(min(candidates), now_ts + ALERT_MIN_RECHECK)
+        return new_alerts
+
+
+def format_alert(alert: Alert, series: ForecastSeries, now_ts: float) -> str:
+    """Текст предупреждения для одного Alert по прогнозу его города."""
+    index = series.window(alert.time, alert.time)[0]
+    forecast_utc_time = datetime.datetime.fromtimestamp(alert.time, datetime.timezone.utc)
+    local_time_str = forecast_utc_time.strftime('%H:%M')  # По умолчанию UTC
+    if series.utc_offset is not None:
+        city_tz = datetime.timezone(datetime.timedelta(seconds=series.utc_offset))
+        local_time_str = forecast_utc_time.astimezone(city_tz).strftime('%H:%M')
+    minutes = max((alert.time - now_ts) / 60.0, 0)
+    temp = round(series.temps[index])
+    wind = round(series.winds[index])
+
+    if alert.kind == "precipitation":
+        description = series.description(index) or "осадки"
+        return (f"Ожидаются осадки ({description}) примерно в {local_time_str} по местному времени "
+                f"(через ~{int(minutes // 60)} ч {int(minutes % 60)} мин).")
+    if alert.kind == "cold":
+        return f"🧊 Очень холодно: до {temp}°C около {local_time_str} по местному времени."
+    if alert.kind == "heat":
+        return f"🔥 Жара: до {temp}°C около {local_time_str} по местному времени."
+    if alert.kind == "wind":
+        return f"🌪 Сильный ветер: {wind} м/с около {local_time_str} по местному времени."
+    if alert.kind == "temp_drop":
+        return (f"📉 Резкое похолодание: к {local_time_str} по местному времени до {temp}°C "
+                f"(минус {ALERT_TEMP_DROP:g}°C и больше за {ALERT_TEMP_DROP_HOURS} ч).")
+    return f"⚠️ {alert.kind} около {local_time_str} по местному времени."
@@ -1,24 +1,47 @@
 import os
+import asyncio
+import hmac
 import logging
+import threading
 import datetime  # Используем datetime.datetime и datetime.time
 import pytz
 
 from fastapi import FastAPI, Request
-from aiogram import Bot, Dispatcher, Router, F, types  # Добавили types для callback_query
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import Update, Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, \
     InlineKeyboardButton
 from aiogram.filters import Command, CommandStart
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from dotenv import load_dotenv
 
 # Импорты из твоих модулей
-from weather_api import get_weather, get_forecast, check_for_precipitation_in_forecast
+from weather_api import (
+    get_weather, get_forecast, get_forecast_series,
+    get_weather_batch, prefetch_weather, format_weather_response, rendered_messages, data_key, age_label,
+    init_http_session, close_http_session, normalize_city,
+    weather_priority, quota_status, PRIORITY_DAILY, PRIORITY_ALERTS
+)
+from alerts import AlertPlanner, format_alert
+from delivery import DeliveryPipeline
+from outbox import OutboxRelay
+from city_registry import CityRegistry
+from leader import LeaderElector
+from loop_monitor import LoopMonitor
+from metrics import QUEUE_DEPTH, WEBHOOK_SECONDS, HandlerTimingMiddleware, instrument_scheduler, render_latest
+from pg_storage import PostgresStorage
+from profiler import SamplingProfiler
+from sharding import SCHEDULER_SHARDS, ShardLeaseManager
+from update_queue import UpdateQueue
+from timing_wheel import TimingWheel, WheelEntry
 from database import (
-    get_pool, save_request, get_history,
+    get_pool, get_connection, get_history, HistoryWriter,
     add_subscription, remove_subscription, get_user_subscriptions,
-    get_all_active_subscriptions_with_details, update_last_alert_time, update_last_daily_sent_time
+    get_all_active_subscriptions_with_details, get_active_subscriptions_for_cities,
+    ensure_schema, enqueue_notifications, enqueue_daily_notifications, get_outbox_backlog, purge_sent_outbox,
+    get_subscription_cities_without_id, set_subscription_city_ids,
+    compute_next_daily_fire, reschedule_next_daily_fire_times, get_active_timezones
 )
 
 # APScheduler
@@ -30,6 +53,7 @@ from apscheduler.triggers.cron import CronTrigger
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")  # Убедимся, что он есть для геокодинга
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # доступ к отладочным эндпоинтам; не задан — они выключены
 
 # Логирование
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
@@ -39,15 +63,41 @@ logger = logging.getLogger(__name__)
 app = FastAPI()
 
 # Aiogram setup
-storage = MemoryStorage()
+# FSM хранится в Postgres, чтобы диалог не зависел от конкретного воркера/реплики
+storage = PostgresStorage()
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+# время каждого хендлера (по состояниям FSM) — в /metrics, медленные — в лог
+router.message.middleware(HandlerTimingMiddleware())
+router.callback_query.middleware(HandlerTimingMiddleware())
 
 # Глобальные переменные
 pool = None
+# Входящие апдейты обрабатываются в фоне (вебхук отвечает сразу)
+update_queue = UpdateQueue(dp, bot)
 scheduler = AsyncIOScheduler(timezone=pytz.utc)
+instrument_scheduler(scheduler)
+# Справочник городов: разные написания -> один город OpenWeather
+city_registry = CityRegistry()
+# Расписание утренних прогнозов в памяти (1440 минутных слотов), загружается из БД при старте
+subscription_wheel = TimingWheel()
+# Конвейер исходящих сообщений для рассылок (лимиты Telegram, повторы)
+delivery = DeliveryPipeline(bot)
+# Рассылки пишутся в notification_outbox, а отправляет их OutboxRelay — только в одном процессе
+# (лидер или владелец шарда 0), чтобы лимит сообщений в секунду был общим на весь бот
+outbox_relay = OutboxRelay(delivery)
+# История запросов пишется в БД в фоне пачками через COPY
+history_writer = HistoryWriter()
+# Когда перепроверять прогноз каждого города на предупреждения
+alert_planner = AlertPlanner()
+# Города подписчиков своих шардов: ключ города -> (название, city_id, написания подписок без id).
+# Обновляется вместе с колесом (загрузка и сверка раз в 10 минут), чтобы задача предупреждений
+# не читала все подписки каждые 5 минут
+alert_cities: dict[int | str, tuple] = {}
+# Лаг event loop и блокирующие вызовы в корутинах (стек — в лог)
+loop_monitor = LoopMonitor()
 
 
 # --- ОПРЕДЕЛЕНИЕ СОСТОЯНИЙ FSM (ОДНО ОБЪЕДИНЕННОЕ ОПРЕДЕЛЕНИЕ) ---
@@ -146,15 +196,13 @@ async def process_current_weather_city(message: Message, state: FSMContext):
     global pool
     if not pool: pool = await get_pool()
 
-    weather_info = await get_weather(city)
+    weather_info = await get_weather(city, city_id=await city_registry.resolve_id(city))
     await message.answer(weather_info, reply_markup=main_menu_keyboard())
 
     # Сохранение в историю (опционально)
     if message.from_user and message.from_user.username and "Ошибка:" not in weather_info:
-        try:
-            await save_request(pool, message.from_user.username, city, datetime.datetime.now())
-        except Exception as e:
-            logger.error(f"Error saving current weather request for {city}: {e}")
+        # пишется в фоне (см. HistoryWriter), хендлер не ждёт БД
+        history_writer.submit(message.from_user.username, city, datetime.datetime.now())
 
 
 # --- Прогноз на 3 дня ---
@@ -179,15 +227,12 @@ async def process_forecast_city(message: Message, state: FSMContext):
     global pool
     if not pool: pool = await get_pool()
 
-    forecast_info = await get_forecast(city)
+    forecast_info = await get_forecast(city, city_id=await city_registry.resolve_id(city))
     await message.answer(forecast_info, reply_markup=main_menu_keyboard())
 
     # Сохранение в историю (опционально)
     if message.from_user and message.from_user.username and "Ошибка:" not in forecast_info:
-        try:
-            await save_request(pool, message.from_user.username, city, datetime.datetime.now())
-        except Exception as e:
-            logger.error(f"Error saving forecast request for {city}: {e}")
+        history_writer.submit(message.from_user.username, city, datetime.datetime.now())
 
 # --- Управление подписками ---
 @router.message(F.text == "🔔 Мои подписки")
@@ -249,6 +294,7 @@ async def process_city_management_action(message: Message, state: FSMContext):
         global pool; pool = pool or await get_pool()
         try:
             await remove_subscription(pool, message.from_user.id, city_to_manage)
+            subscription_wheel.remove(message.from_user.id, city_to_manage)
             await state.clear()
             await message.answer(f"🗑 Вы отписались от г. {city_to_manage}.", reply_markup=main_menu_keyboard())
         except Exception as e:
@@ -328,6 +374,7 @@ async def process_city_management_action(message: Message, state: FSMContext):
         user_id = message.from_user.id
         try:
             await remove_subscription(pool, user_id, city_to_manage)
+            subscription_wheel.remove(user_id, city_to_manage)
             await state.clear()
             await message.answer(f"🗑 Вы отписались от г. {city_to_manage}.", reply_markup=main_menu_keyboard())
         except Exception as e:
@@ -376,8 +423,13 @@ async def process_new_city_for_subscription(message: Message, state: FSMContext)
     if not pool:
         pool = await get_pool()
 
-    weather_check = await get_weather(city_input)
-    if "Ошибка:" in weather_check:
+    # Проверяем город через справочник (кэш/БД), полный запрос погоды не нужен
+    try:
+        city_info = await city_registry.resolve(city_input)
+    except Exception as e:
+        logger.error(f"Ошибка проверки города {city_input}: {e}")
+        city_info = None
+    if city_info is None:
         await message.reply(f"Город '{city_input}' не найден или произошла ошибка при проверке API. Попробуйте другой город.",
                             reply_markup=back_to_main_menu_keyboard())
         return
@@ -401,7 +453,9 @@ async def process_new_city_for_subscription(message: Message, state: FSMContext)
 
     try:
         # ... определение user_timezone_str ...
-        await add_subscription(pool, message.from_user.id, city_input, "08:00:00", user_timezone_str)
+        sub_row = await add_subscription(pool, message.from_user.id, city_input, "08:00:00", user_timezone_str,
+                                         city_id=city_info["id"])
+        subscription_wheel.add_row(sub_row)
         await state.update_data(configuring_city=city_input, current_timezone=user_timezone_str)
         await state.set_state(WeatherStates.choosing_timezone_text_input)
         await message.answer(f"✅ Город {city_input} добавлен (утро в 08:00, пояс {user_timezone_str}).\n"
@@ -459,7 +513,8 @@ async def process_notification_time_text_input(message: Message, state: FSMConte
     global pool;
     pool = pool or await get_pool()
     try:
-        await add_subscription(pool, message.from_user.id, city, time_for_db, tz)
+        sub_row = await add_subscription(pool, message.from_user.id, city, time_for_db, tz)
+        subscription_wheel.add_row(sub_row)
         await message.answer(f"👍 Настройки для г. {city} сохранены: {parsed_time.strftime('%H:%M')} ({tz}).",
                              reply_markup=main_menu_keyboard())
     except Exception as e:
@@ -553,6 +608,7 @@ async def process_city_for_unsubscription_text(message: Message, state: FSMConte
             return  # Остаемся в том же состоянии
 
         await remove_subscription(pool, user_id, found_subscription_city)  # Используем точное имя
+        subscription_wheel.remove(user_id, found_subscription_city)
         await message.answer(
             f"🗑 Вы успешно отписались от уведомлений для г. {found_subscription_city}.",
             reply_markup=main_menu_keyboard()  # Возвращаем в главное меню
@@ -628,6 +684,7 @@ async def catch_all_messages_debug(message: Message, state: FSMContext):
 # Отправка утреннего (или любого заданного) прогноза по локальному
 # времени из подписки. Вызывается планировщиком каждую минуту.
 # ------------------------------------------------------------------
+@weather_priority(PRIORITY_DAILY)
 async def send_daily_morning_forecast_local_time() -> None:
     global pool, bot
 
@@ -636,148 +693,400 @@ async def send_daily_morning_forecast_local_time() -> None:
         logger.warning("Scheduler: pool/bot not initialized")
         return
 
+    MISSED_GRACE = 300  # опоздали больше чем на 5 мин — не шлём, переносим на завтра
+
     now_utc = datetime.datetime.now(pytz.utc).replace(microsecond=0)
 
-    # --- берём все активные подписки ---
+    async with subscription_wheel.lock:
+        # --- из колеса забираем только текущий слот ---
+        due = subscription_wheel.drain(now_utc + datetime.timedelta(seconds=30))
+        if not due:
+            return
+        notifications: list[tuple] = []
+        # (user_id, city, fired_at, next_fire_at): БД подтвердит, что подписка всё ещё ждёт fired_at
+        fire_updates: list[tuple] = []
+
+        # --- погода для всех городов тика — пачками по 20 id (/group) ---
+        try:
+            weather_by_city_id = await get_weather_batch({
+                e.city_id for e in due
+                if e.city_id is not None and (now_utc - e.fire_at).total_seconds() <= MISSED_GRACE
+            })
+        except Exception as e:
+            logger.error(f"Scheduler: batch weather request failed: {e}", exc_info=True)
+            weather_by_city_id = {}
+
+        # --- обрабатываем каждую подписку ---
+        for entry in due:
+            user_id  = entry.user_id
+            city     = entry.city
+            notif_tm = entry.notification_time
+            tz_name  = entry.timezone
+
+            # пропускаем неполные записи
+            if not user_id or not city or notif_tm is None:
+                continue
+
+            try:
+                next_fire_at = compute_next_daily_fire(notif_tm, tz_name, now_utc + datetime.timedelta(seconds=30))
+            except pytz.UnknownTimeZoneError:
+                logger.error(f"Scheduler: unknown tz {tz_name} for user {user_id}")
+                continue
+            next_entry = WheelEntry(user_id, city, notif_tm, tz_name, next_fire_at, entry.city_id)
+
+            if (now_utc - entry.fire_at).total_seconds() > MISSED_GRACE:
+                logger.warning(f"Scheduler: missed forecast for {city} (user {user_id}) at {entry.fire_at}, rescheduling")
+                fire_updates.append((user_id, city, entry.fire_at, next_fire_at))
+                _reschedule_daily(next_entry)
+                continue
+
+            logger.info(f"Scheduler: sending forecast for {city} (user {user_id})")
+
+            # --- получаем погоду (города без id или не вернувшиеся из /group — по одному) ----
+            data = weather_by_city_id.get(entry.city_id)
+            if data is not None:
+                # подписчики города с одинаковым написанием, временем и поясом получают один и тот же текст
+                msg = rendered_messages.render(
+                    data_key("weather", city, entry.city_id), data.get("dt"), "daily",
+                    (city, notif_tm.strftime('%H:%M'), tz_name, age_label(data)),
+                    lambda: _daily_message(city, notif_tm, tz_name, format_weather_response(data, city))
+                )
+            else:
+                try:
+                    weather_txt = await get_weather(city, city_id=entry.city_id)
+                except Exception as e:
+                    # сбой одного города не должен срывать весь тик: остальные подписки уже забраны из колеса
+                    logger.error(f"Scheduler: weather request failed for {city}: {e}", exc_info=True)
+                    subscription_wheel.add(entry)
+                    continue
+                if "Ошибка:" in weather_txt:
+                    # возвращаем в колесо с прежним временем: повторим на следующем тике (в пределах MISSED_GRACE)
+                    logger.warning(f"Scheduler: weather API error for {city}: {weather_txt}")
+                    subscription_wheel.add(entry)
+                    continue
+                msg = _daily_message(city, notif_tm, tz_name, weather_txt)
+
+            # --- шлём сообщение ---
+            # ключ идемпотентности: одна утренняя рассылка на подписку и время срабатывания
+            notifications.append(("daily", user_id, city, msg, f"daily:{user_id}:{city}:{entry.fire_at.isoformat()}"))
+
+            # --- следующая отправка — завтра в то же локальное время ---
+            fire_updates.append((user_id, city, entry.fire_at, next_fire_at))
+            _reschedule_daily(next_entry)
+
+        # --- уведомления в outbox и новое время отправки — одной транзакцией на весь тик ---
+        try:
+            confirmed, current_rows = await enqueue_daily_notifications(pool, notifications, fire_updates)
+        except Exception as e:
+            logger.error(f"Scheduler: can't enqueue daily notifications: {e}", exc_info=True)
+            # ничего не записалось — возвращаем подписки в колесо, повторим на следующем тике
+            for entry in due:
+                subscription_wheel.add(entry)
+            return
+
+        # --- подписки, изменённые или удалённые на другой реплике: в колесо — то, что сейчас в БД ---
+        for user_id, city, _, _ in fire_updates:
+            if (user_id, city) not in confirmed:
+                subscription_wheel.remove(user_id, city)
+        for row in current_rows:
+            subscription_wheel.add_row(row)
+        skipped = len(fire_updates) - len(confirmed)
+        if skipped:
+            logger.info(f"Scheduler: {skipped} subscriptions changed elsewhere since loaded, not sending")
+
+    # --- отправка идёт в фоне (OutboxRelay → конвейер доставки), тик не ждёт её окончания ---
+    outbox_relay.wake()
+
+
+# Прогрев кэша погоды перед утренней рассылкой
+PREFETCH_LOOKAHEAD_MINUTES = int(os.getenv("PREFETCH_LOOKAHEAD_MINUTES", "5"))
+PREFETCH_MAX_CALLS = int(os.getenv("PREFETCH_MAX_CALLS", "30"))  # запросов /group за запуск
+
+
+@weather_priority(PRIORITY_DAILY)
+async def prefetch_upcoming_weather() -> None:
+    """
+    За PREFETCH_LOOKAHEAD_MINUTES минут до отправки загружает погоду городов подписок
+    из колеса, чтобы тик в назначенную минуту только собирал и ставил сообщения.
+    """
+    now_utc = datetime.datetime.now(pytz.utc)
+    # то, что уйдёт ближайшим тиком (fire_at <= now + 30 с), тик уже загружает сам
+    upcoming = subscription_wheel.peek(now_utc + datetime.timedelta(seconds=30),
+                                       now_utc + datetime.timedelta(minutes=PREFETCH_LOOKAHEAD_MINUTES))
+    city_ids = {entry.city_id for entry in upcoming if entry.city_id is not None}
+    if not city_ids:
+        return
     try:
-        subscriptions = await get_all_active_subscriptions_with_details(pool)
+        # данные должны остаться свежими до последней подписки окна (+ минута запаса)
+        fetched = await prefetch_weather(city_ids, fresh_for=(PREFETCH_LOOKAHEAD_MINUTES + 1) * 60,
+                                         max_calls=PREFETCH_MAX_CALLS)
     except Exception as e:
-        logger.error(f"Scheduler: DB error: {e}", exc_info=True)
+        logger.error(f"Scheduler(prefetch): failed: {e}", exc_info=True)
         return
+    if fetched:
+        logger.info(f"Scheduler(prefetch): warmed weather for {fetched}/{len(city_ids)} cities "
+                    f"of {len(upcoming)} upcoming subscriptions")
 
-    if not subscriptions:
-        return
 
-    # --- обрабатываем каждую подписку ---
-    for sub in subscriptions:
-        user_id   = sub.get("user_id")
-        city      = sub.get("city")
-        notif_tm  = sub.get("notification_time")      # TIME
-        tz_name   = sub.get("timezone") or "UTC"
-        last_sent = sub.get("last_daily_sent_at")     # TIMESTAMP, может быть None
+def _daily_message(city: str, notif_tm: datetime.time, tz_name: str, weather_txt: str) -> str:
+    return (
+        f"☀️ Доброе утро!\n\n"
+        f"Погода в {city} на {notif_tm.strftime('%H:%M')} "
+        f"(ваш пояс {tz_name}):\n\n{weather_txt}"
+    )
 
-        # пропускаем неполные записи
-        if not user_id or not city or notif_tm is None:
-            continue
 
-        # защита: если уже слали < 60 сек назад
-        if last_sent and (now_utc - last_sent).total_seconds() < 60:
-            continue
+def _reschedule_daily(entry: WheelEntry) -> None:
+    if entry.key in subscription_wheel:
+        return  # пока шёл тик, пользователь сам изменил подписку
+    subscription_wheel.add(entry)
 
-        # --- локальное время пользователя ---
-        try:
-            user_tz = pytz.timezone(tz_name)
-        except pytz.UnknownTimeZoneError:
-            logger.error(f"Scheduler: unknown tz {tz_name} for user {user_id}")
-            continue
 
-        local_today   = now_utc.astimezone(user_tz).date()
-        local_target  = datetime.datetime.combine(local_today, notif_tm)
-        local_target  = user_tz.localize(local_target, is_dst=None)
-        target_utc_dt = local_target.astimezone(pytz.utc).replace(microsecond=0)
+async def reconcile_subscription_wheel() -> None:
+    """Периодическая сверка колеса с БД (подписки, изменённые другими процессами, и т.п.)."""
+    global pool
+    if not pool:
+        return
+    try:
+        rows = await get_all_active_subscriptions_with_details(pool)
+    except Exception as e:
+        logger.error(f"Scheduler(reconcile): DB error: {e}", exc_info=True)
+        return
+    _refresh_alert_cities(rows)
+    async with subscription_wheel.lock:
+        drift = subscription_wheel.reconcile(rows)
+    if drift:
+        logger.warning(f"Scheduler(reconcile): fixed {drift} wheel entries out of sync with DB")
 
-        # --- попали в окно ±30 сек? ---
-        if abs((now_utc - target_utc_dt).total_seconds()) > 30:
-            continue
 
-        logger.info(f"Scheduler: sending forecast for {city} (user {user_id})")
+# Текущие UTC-смещения поясов подписчиков — чтобы заметить переход на летнее/зимнее время
+_known_tz_offsets: dict[str, datetime.timedelta] = {}
 
-        # --- получаем погоду ----
-        weather_txt = await get_weather(city)
-        if "Ошибка:" in weather_txt:
-            logger.warning(f"Scheduler: weather API error for {city}: {weather_txt}")
-            continue
 
-        # --- шлём сообщение ---
-        msg = (
-            f"☀️ Доброе утро!\n\n"
-            f"Погода в {city} на {notif_tm.strftime('%H:%M')} "
-            f"(ваш пояс {tz_name}):\n\n{weather_txt}"
-        )
-        try:
-            await bot.send_message(user_id, msg)
-            logger.info(f"Scheduler: sent to {user_id} for {city}")
+async def refresh_fire_times_on_dst_change() -> None:
+    """
+    Пересчитывает next_daily_fire_at для поясов, у которых изменилось UTC-смещение.
+    Каждый процесс переносит только подписки своего колеса (в шардированном режиме — своих шардов).
+    """
+    global pool
+    if not pool:
+        return
+    now_utc = datetime.datetime.now(pytz.utc)
+    try:
+        timezones = await get_active_timezones(pool)
+    except Exception as e:
+        logger.error(f"Scheduler(DST): DB error: {e}", exc_info=True)
+        return
 
-            # фиксируем время последней отправки
+    changed = []
+    for tz_name in timezones:
+        try:
+            offset = now_utc.astimezone(pytz.timezone(tz_name)).utcoffset()
+        except pytz.UnknownTimeZoneError:
+            continue
+        if tz_name in _known_tz_offsets and _known_tz_offsets[tz_name] != offset:
+            changed.append(tz_name)
+        _known_tz_offsets[tz_name] = offset
+
+    if changed:
+        async with subscription_wheel.lock:
+            moves = []
+            for entry in subscription_wheel.entries_for_timezones(changed):
+                try:
+                    moves.append((entry, compute_next_daily_fire(entry.notification_time, entry.timezone, now_utc)))
+                except pytz.UnknownTimeZoneError:
+                    continue
             try:
-                await update_last_daily_sent_time(pool, user_id, city, now_utc)
+                moved = await reschedule_next_daily_fire_times(
+                    pool, [(entry.user_id, entry.city, entry.fire_at, fire_at) for entry, fire_at in moves]
+                )
             except Exception as e:
-                logger.error(f"Scheduler: can't update last_daily_sent_time: {e}", exc_info=True)
-
-        except Exception as e:
-            logger.error(f"Scheduler: telegram send error: {e}", exc_info=True)
+                logger.error(f"Scheduler(DST): recompute failed: {e}", exc_info=True)
+                return
+            logger.info(f"Scheduler(DST): offset changed for {changed}, rescheduled {len(moved)} subscriptions")
+            # перекладываем затронутые записи колеса в новые слоты; изменённые в другом месте поправит сверка с БД
+            for entry, fire_at in moves:
+                if entry.key in moved:
+                    entry.fire_at = fire_at
+                    subscription_wheel.add(entry)
 
 
 
-# 2. send_precipitation_alert (код из предыдущего ответа, который использует last_alert_sent_at и check_for_precipitation_in_forecast)
+# 2. send_weather_alerts
 # ------------------------------------------------------------------
-# Проверка прогноза раз в 15 мин. Если в диапазоне 30-120 минут
-# впереди ожидаются осадки (rain / snow / drizzle), бот предупредит.
+# Прогнозы городов с подписками проверяются правилами из alerts.ALERT_RULES
+# (осадки в ближайший час, мороз, жара, сильный ветер, резкое похолодание) за один проход.
+# Задача запускается каждые 5 минут, но город проверяется только тогда, когда
+# alert_planner считает, что могло появиться что-то новое (новый прогноз или
+# известный интервал входит в окно предупреждения).
 # ------------------------------------------------------------------
-async def send_precipitation_alert() -> None:
+@weather_priority(PRIORITY_ALERTS)
+async def send_weather_alerts() -> None:
     global pool, bot
     if not pool or not bot:
-        logger.warning("Scheduler(Prec): pool/bot not initialized")
+        logger.warning("Scheduler(Alerts): pool/bot not initialized")
         return
 
     # настройки
-    COOLDOWN  = 1800        # 30 мин
-    MIN_LEAD  = 0           # реагируем, даже если дождь уже начинается
-    MAX_LEAD  = 60          # и до 1 ч вперёд
+    CONCURRENCY = 10        # одновременных запросов прогноза
 
     now_utc = datetime.datetime.now(pytz.utc)
+    now_ts = now_utc.timestamp()
 
+    # снимок: _refresh_alert_cities может заменить словарь, пока задача ждёт прогнозы или БД
+    cities = alert_cities
+    due_cities = alert_planner.due(cities, now_ts)
+    if not due_cities:
+        return
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def fetch_city(city_key, city: str, city_id: int | None):
+        async with semaphore:
+            try:
+                series = await get_forecast_series(city, city_id)
+            except Exception as e:
+                logger.error(f"Alerts: forecast failed for {city}: {e}", exc_info=True)
+                series = None
+        return city_key, series
+
+    # один прогноз на город, а не на подписку
+    results = await asyncio.gather(
+        *(fetch_city(city_key, cities[city_key][0], cities[city_key][1]) for city_key in due_cities)
+    )
+    series_by_city = {}
+    for city_key, series in results:
+        if series is None:
+            alert_planner.postpone(city_key, now_ts)
+        else:
+            series_by_city[city_key] = series
+    alerts_by_city: dict[int | str, list] = {}
+    for alert in alert_planner.evaluate(series_by_city, now_ts):
+        alerts_by_city.setdefault(alert.city, []).append(alert)
+    logger.info(f"Alerts: checked {len(series_by_city)}/{len(cities)} cities, "
+                f"{len(alerts_by_city)} with alerts")
+    if not alerts_by_city:
+        return
+
+    # подписчики — из БД и только для городов с предупреждениями: список городов в памяти может отставать
     try:
-        subs = await get_all_active_subscriptions_with_details(pool)
+        subs = await get_active_subscriptions_for_cities(
+            pool,
+            [key for key in alerts_by_city if cities[key][1] is not None],
+            [city for key in alerts_by_city for city in cities[key][2]],
+        )
     except Exception as e:
-        logger.error(f"Prec-alert: DB error: {e}", exc_info=True)
+        logger.error(f"Alerts: DB error: {e}", exc_info=True)
+        alert_planner.retract([alert for city_alerts in alerts_by_city.values() for alert in city_alerts], now_ts)
         return
-
+    subs_by_city: dict[int | str, list] = {}
     for sub in subs:
-        user_id = sub["user_id"]
-        city    = sub["city"]
-        last_ts = sub.get("last_alert_sent_at")   # ← берём ЛЕВУЮ колонку
+        if not _owns_subscriber(sub["user_id"]):
+            continue  # подписчик из чужого шарда
+        subs_by_city.setdefault(_alert_city_key(sub), []).append(sub)
+
+    notifications: list[tuple] = []
+    for city_key, city_alerts in alerts_by_city.items():
+        series = series_by_city[city_key]
+        city_alerts.sort(key=lambda a: a.time)
+        lines = "\n".join(format_alert(alert, series, now_ts) for alert in city_alerts)
+        umbrella = any(alert.kind == "precipitation" for alert in city_alerts)
+        # планировщик отдаёт только начавшиеся эпизоды; ключ — вид и начало эпизода (первый интервал серии
+        # в прогнозе), поэтому после перезапуска или смены лидера тот же эпизод не уйдёт повторно,
+        # пока его начало ещё есть в прогнозе
+        episodes = ",".join(sorted(f"{alert.kind}:{alert.since}" for alert in city_alerts))
+
+        for sub in subs_by_city.get(city_key, ()):
+            user_id = sub["user_id"]
+            city    = sub["city"]
+
+            msg = rendered_messages.render(
+                data_key("forecast", city, sub["city_id"]), series.version, "alert", (city, lines),
+                lambda: _alert_message(city, lines, umbrella)
+            )
+            notifications.append(("alert", user_id, city, msg, f"alert:{user_id}:{city}:{episodes}"))
 
-        # анти-спам: ждём минимум 30 мин с прошлого алерта
-        if last_ts and (now_utc - last_ts).total_seconds() < COOLDOWN:
-            continue
+    try:
+        await enqueue_notifications(pool, notifications)
+    except Exception as e:
+        logger.error(f"Alerts: can't enqueue notifications: {e}", exc_info=True)
+        # предупреждения не записались — эпизоды забываются, города проверим снова через ALERT_MIN_RECHECK
+        alert_planner.retract([alert for city_alerts in alerts_by_city.values() for alert in city_alerts], now_ts)
+        return
+    outbox_relay.wake()
 
-        # проверяем прогноз
-        try:
-            alert = await check_for_precipitation_in_forecast(
-                city,
-                min_lead_minutes=MIN_LEAD,
-                max_lead_minutes=MAX_LEAD
-            )
-        except Exception as e:
-            logger.error(f"Prec-alert: checker failed for {city}: {e}", exc_info=True)
-            continue
 
-        if not alert:
-            continue     # осадков нет — едем дальше
+def _alert_city_key(sub) -> int | str:
+    # все написания одного города — один ключ (id OpenWeather), для старых подписок — нормализованное имя
+    return sub["city_id"] or normalize_city(sub["city"])
 
-        # отправляем сообщение
-        msg = (
-            f"🌧 Внимание!\n\n"
-            f"{city}: {alert}\n"
-            "Возьмите зонт или запланируйте маршрут под крышами ☔️"
-        )
-        try:
-            await bot.send_message(user_id, msg)
-            logger.info(f"Prec-alert: sent to {user_id} for {city}")
-        except Exception as e:
-            logger.error(f"Prec-alert: telegram send error: {e}", exc_info=True)
-            continue
 
-        # фиксируем время последнего осадочного алерта
-        try:
-            await update_last_alert_time(pool, user_id, city)   # поле по умолчанию — last_alert_sent_at
-        except Exception as e:
-            logger.error(f"Prec-alert: can't update last_alert_sent_at: {e}", exc_info=True)
+def _refresh_alert_cities(rows) -> None:
+    global alert_cities
+    cities: dict[int | str, tuple] = {}
+    for row in rows:
+        if not _owns_subscriber(row["user_id"]):
+            continue  # подписчик из чужого шарда
+        city, city_id, spellings = cities.setdefault(_alert_city_key(row), (row["city"], row["city_id"], set()))
+        if city_id is None:
+            spellings.add(row["city"])
+    alert_cities = cities
+
+
+def _alert_message(city: str, lines: str, umbrella: bool) -> str:
+    msg = f"⚠️ Внимание!\n\n{city}:\n{lines}"
+    if umbrella:
+        msg += "\nВозьмите зонт или запланируйте маршрут под крышами ☔️"
+    return msg
+
+
+async def purge_expired_fsm_states() -> None:
+    if not _owns_global_work():
+        return
+    try:
+        count = await storage.purge_expired()
+        if count:
+            logger.info(f"FSM: purged {count} expired states")
+    except Exception as e:
+        logger.error(f"FSM: purge failed: {e}", exc_info=True)
+
+
+@weather_priority(PRIORITY_ALERTS)
+async def backfill_subscription_cities() -> None:
+    """Проставляет city_id подпискам, созданным до появления справочника городов."""
+    if not _owns_global_work():
+        return
+    try:
+        cities = await get_subscription_cities_without_id(pool)
+    except Exception as e:
+        logger.error(f"Cities: DB error: {e}", exc_info=True)
+        return
+    if not cities:
+        return
+    semaphore = asyncio.Semaphore(5)
 
+    async def resolve(city: str):
+        async with semaphore:
+            return city, await city_registry.resolve_id(city)
 
+    resolved = [(city, city_id) for city, city_id in await asyncio.gather(*map(resolve, cities)) if city_id]
+    try:
+        await set_subscription_city_ids(pool, resolved)
+        logger.info(f"Cities: linked {len(resolved)}/{len(cities)} subscription city names to city ids")
+    except Exception as e:
+        logger.error(f"Cities: can't save city ids: {e}", exc_info=True)
 
 
+async def purge_old_outbox() -> None:
+    if not _owns_global_work():
+        return
+    try:
+        count = await purge_sent_outbox(pool, datetime.timedelta(days=7))
+        if count:
+            logger.info(f"Outbox: purged {count} old notifications")
+    except Exception as e:
+        logger.error(f"Outbox: purge failed: {e}", exc_info=True)
+
 
 # --- FastAPI эндпоинты и жизненный цикл ---
 @app.get("/")
@@ -788,32 +1097,161 @@ async def root():
 
 @app.post("/webhook") # <--- ВОТ ОН, КЛЮЧЕВОЙ ОБРАБОТЧИК!
 async def telegram_webhook(request: Request):
-    logger.info(">>> Webhook endpoint CALLED!")
+    with WEBHOOK_SECONDS.time():
+        return await _accept_update(request)
+
+
+async def _accept_update(request: Request):
+    # Только разбираем апдейт и ставим в очередь: Telegram получает ответ сразу,
+    # а обработка (OpenWeather, Postgres) идёт в воркерах UpdateQueue
     try:
-        body = await request.json()
-        # Логируем только часть тела, чтобы не переполнять логи, если оно большое
-        logger.info(f">>> Webhook BODY received (keys): {list(body.keys()) if isinstance(body, dict) else 'Not a dict'}")
-        if logger.level == logging.DEBUG: # Полное тело только в DEBUG режиме
-             logger.debug(f">>> Full Webhook BODY: {body}")
-
-        update = types.Update(**body) # Используем types.Update для корректного маппинга
-        logger.info(">>> Update object CREATED.")
-        await dp.feed_update(bot=bot, update=update) # Передаем именованные аргументы
-        logger.info(">>> dp.feed_update COMPLETED.")
-        return {"ok": True}
+        body = await request.body()
+        if logger.isEnabledFor(logging.DEBUG): # Полное тело только в DEBUG режиме
+             logger.debug(f">>> Full Webhook BODY: {body!r}")
+        update = Update.model_validate_json(body, context={"bot": bot})
     except Exception as e:
         logger.exception(">>> EXCEPTION in webhook processing:")
         return {"ok": False, "error": str(e)}
 
+    if not update_queue.submit(update):
+        # очередь переполнена — пусть Telegram повторит доставку позже
+        return JSONResponse(status_code=503, content={"ok": False, "error": "queue is full"})
+    return {"ok": True}
+
+
+@app.get("/status")
+async def status():
+    try:
+        outbox_backlog = await get_outbox_backlog(pool) if pool else None
+    except Exception as e:
+        logger.error(f"Status: can't read outbox backlog: {e}")
+        outbox_backlog = None
+    return {
+        "outbox_backlog": outbox_backlog,
+        "update_queue_depth": update_queue.queue_depth,
+        "update_duplicates": update_queue.duplicates,
+        "delivery_queue_depth": delivery.queue_depth,
+        "history_queue_depth": history_writer.queue_depth,
+        "history_dropped": history_writer.dropped,
+        "wheel_subscriptions": len(subscription_wheel),
+        "alert_planned_cities": len(alert_planner),
+        "event_loop_max_lag": round(loop_monitor.max_lag, 3),
+        "openweather": quota_status(),
+        "scheduler_leader": leader_elector.status() if shard_manager is None else None,
+        "scheduler_shards": shard_manager.status() if shard_manager is not None else None,
+    }
+
+@app.get("/metrics")
+async def metrics():
+    QUEUE_DEPTH.labels("updates").set(update_queue.queue_depth)
+    QUEUE_DEPTH.labels("delivery").set(delivery.queue_depth)
+    QUEUE_DEPTH.labels("history").set(history_writer.queue_depth)
+    QUEUE_DEPTH.labels("wheel").set(len(subscription_wheel))
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
+
+profiler = SamplingProfiler()
+
+
+def _is_admin(request: Request) -> bool:
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10):
+    """Семплирует event loop seconds секунд и возвращает collapsed stacks (для flamegraph)."""
+    if not _is_admin(request):
+        return JSONResponse(status_code=403, content={"ok": False, "error": "forbidden"})
+    if profiler.busy:
+        return JSONResponse(status_code=409, content={"ok": False, "error": "profiler is already running"})
+    loop_thread_id = threading.get_ident()
+    try:
+        stacks = await asyncio.to_thread(profiler.sample, loop_thread_id, seconds)
+    except RuntimeError as e:
+        return JSONResponse(status_code=409, content={"ok": False, "error": str(e)})
+    return PlainTextResponse(stacks)
+
+
+async def _on_became_leader() -> None:
+    # Загрузка расписания утренних прогнозов в память и запуск задач
+    try:
+        rows = await get_all_active_subscriptions_with_details(pool)
+        subscription_wheel.load(rows, datetime.datetime.now(pytz.utc))
+        _refresh_alert_cities(rows)
+    except Exception as e:
+        logger.error(f"API: can't load subscription wheel: {e}", exc_info=True)
+    scheduler.resume()
+    outbox_relay.start(pool)
+    logger.info("APScheduler resumed: this instance runs scheduled jobs.")
+
+
+async def _on_lost_leadership() -> None:
+    if scheduler.running:
+        scheduler.pause()
+    await outbox_relay.stop()
+    logger.info("APScheduler paused: another instance runs scheduled jobs.")
+
+
+leader_elector = LeaderElector(get_connection, _on_became_leader, _on_lost_leadership)
+
+
+async def _on_shards_changed(owned: frozenset) -> None:
+    # outbox отправляет владелец шарда 0
+    if _owns_global_work():
+        outbox_relay.start(pool)
+    else:
+        await outbox_relay.stop()
+    # Перезагружаем колесо: в нём должны быть только подписчики своих шардов
+    async with subscription_wheel.lock:
+        try:
+            rows = await get_all_active_subscriptions_with_details(pool)
+            subscription_wheel.load(rows, datetime.datetime.now(pytz.utc))
+            _refresh_alert_cities(rows)
+        except Exception as e:
+            logger.error(f"API: can't reload subscription wheel for shards {sorted(owned)}: {e}", exc_info=True)
+
+
+# SCHEDULER_SHARDS > 0: задачи выполняют все процессы, каждый — для своих шардов подписчиков;
+# иначе задачи выполняет один лидер
+shard_manager = ShardLeaseManager(SCHEDULER_SHARDS, _on_shards_changed) if SCHEDULER_SHARDS > 0 else None
+
+
+def _owns_subscriber(user_id: int) -> bool:
+    return shard_manager is None or shard_manager.owns(user_id)
+
+
+def _owns_global_work() -> bool:
+    # общая для всех шардов работа — у владельца шарда 0 (без шардов задачи и так выполняет только лидер)
+    return shard_manager is None or 0 in shard_manager.owned
+
+
+subscription_wheel.set_filter(lambda key: _owns_subscriber(key[0]))
+
+
 @app.on_event("startup")
 async def on_startup_combined():
     global pool, scheduler
     logger.info("API: Application startup sequence initiated...")
+    # 0. Сторож event loop — первым, чтобы видеть и блокировки во время старта
+    loop_monitor.start()
     # 1. Инициализация пула БД
     if pool is None:
         logger.info("API: Startup - creating database pool.")
         pool = await get_pool()
         logger.info("API: Database pool created on startup.")
+    try:
+        await ensure_schema(pool)
+    except Exception as e:
+        logger.error(f"API: schema migration failed: {e}", exc_info=True)
+    storage.attach(pool)
+    city_registry.attach(pool)
+    # 1.1. Общий HTTP-клиент для OpenWeather и конвейер доставки сообщений
+    await init_http_session()
+    await delivery.start()
+    history_writer.start(pool)
+    update_queue.start()
     # 2. Проверка вебхука
     try:
         webhook_info = await bot.get_webhook_info()
@@ -834,27 +1272,87 @@ async def on_startup_combined():
     )
     logger.info("Scheduler: Job 'daily_morning_check' set (every minute).")
 
-    # ЗАДАЧА 2: Уведомления об ухудшении погоды (проверка каждый час в XX:05 UTC)
+    # ЗАДАЧА 1.1: прогрев кэша погоды для подписок ближайших минут (в середине минуты, между тиками)
     scheduler.add_job(
-        send_precipitation_alert,
-        CronTrigger(minute=0, timezone=pytz.utc),
-        id="precipitation_check",
+        prefetch_upcoming_weather,
+        CronTrigger(second=30, timezone=pytz.utc),
+        id="weather_prefetch",
         replace_existing=True
     )
-    logger.info("Scheduler: Job 'every_minute_check_for_local_morning' set (every minute).")
-    # scheduler.add_job(
-    #     send_precipitation_alert,
-    #     CronTrigger(minute="*/15", timezone=pytz.utc),  # ← каждые 15 мин
-    #     id="precipitation_check_15m",
-    #     replace_existing=True
-    # )
-    logger.info("Scheduler: Job 'hourly_precipitation_check' set (every hour at XX:05 UTC).")
-
-    if not scheduler.running:
-        try:
-            scheduler.start(); logger.info("APScheduler started.")
-        except Exception as e:
-            logger.error(f"Failed to start APScheduler: {e}")
+    logger.info("Scheduler: Job 'weather_prefetch' set (every minute at :30).")
+
+    # ЗАДАЧА 2: Предупреждения о погоде (осадки, мороз, жара, ветер, похолодание);
+    # запуск каждые 5 минут, города проверяются по плану alert_planner
+    scheduler.add_job(
+        send_weather_alerts,
+        CronTrigger(minute="*/5", timezone=pytz.utc),
+        id="weather_alerts",
+        replace_existing=True
+    )
+    logger.info("Scheduler: Job 'weather_alerts' set (every 5 minutes, per-city plan).")
+
+    # ЗАДАЧА 3: пересчёт времени отправки при переходе на летнее/зимнее время
+    scheduler.add_job(
+        refresh_fire_times_on_dst_change,
+        CronTrigger(minute="*/15", timezone=pytz.utc),
+        id="dst_refresh",
+        replace_existing=True
+    )
+    logger.info("Scheduler: Job 'dst_refresh' set (every 15 minutes).")
+
+    # ЗАДАЧА 4: сверка расписания в памяти с БД
+    scheduler.add_job(
+        reconcile_subscription_wheel,
+        CronTrigger(minute="*/10", second=30, timezone=pytz.utc),
+        id="wheel_reconcile",
+        replace_existing=True
+    )
+    logger.info("Scheduler: Job 'wheel_reconcile' set (every 10 minutes).")
+
+    # ЗАДАЧА 5: удаление истёкших состояний FSM
+    scheduler.add_job(
+        purge_expired_fsm_states,
+        CronTrigger(minute=17, timezone=pytz.utc),
+        id="fsm_purge",
+        replace_existing=True
+    )
+    logger.info("Scheduler: Job 'fsm_purge' set (every hour).")
+
+    # ЗАДАЧА 6: удаление старых записей outbox
+    scheduler.add_job(
+        purge_old_outbox,
+        CronTrigger(hour=3, minute=33, timezone=pytz.utc),
+        id="outbox_purge",
+        replace_existing=True
+    )
+    logger.info("Scheduler: Job 'outbox_purge' set (daily).")
+
+    # ЗАДАЧА 7: привязка старых подписок к справочнику городов
+    scheduler.add_job(
+        backfill_subscription_cities,
+        CronTrigger(minute=45, timezone=pytz.utc),
+        id="cities_backfill",
+        replace_existing=True
+    )
+    logger.info("Scheduler: Job 'cities_backfill' set (every hour).")
+
+    if shard_manager is not None:
+        # 4. Шардированный режим: планировщик работает сразу, шарды раздаёт ShardLeaseManager
+        if not scheduler.running:
+            try:
+                scheduler.start(); logger.info(f"APScheduler started (sharded, {SCHEDULER_SHARDS} shards).")
+            except Exception as e:
+                logger.error(f"Failed to start APScheduler: {e}")
+        shard_manager.start(pool)
+    else:
+        # Планировщик стартует на паузе: задачи выполняет только лидер (см. _on_became_leader)
+        if not scheduler.running:
+            try:
+                scheduler.start(paused=True); logger.info("APScheduler started (paused until elected).")
+            except Exception as e:
+                logger.error(f"Failed to start APScheduler: {e}")
+        # 4. Выбор лидера среди реплик
+        leader_elector.start()
     logger.info("API: Application startup sequence completed.")
 
 
@@ -863,8 +1361,20 @@ async def on_shutdown():
     # ... (ТОЧНО ТАКОЙ ЖЕ КОД, КАК В ПРЕДЫДУЩЕМ ОТВЕТЕ)
     global scheduler, pool
     logger.info("API: Application shutdown sequence initiated...")
+    if shard_manager is not None:
+        await shard_manager.stop()
+    else:
+        await leader_elector.stop()
     if scheduler and scheduler.running: scheduler.shutdown(); logger.info("APScheduler shut down.")
+    await update_queue.stop()
+    await outbox_relay.stop()
+    await delivery.stop()
+    await outbox_relay.flush()
+    await history_writer.close()
+    await close_http_session()
+    await storage.close()
     if pool: await pool.close(); logger.info("Database pool closed.")
+    await loop_monitor.stop()
     logger.info("API: Application shutdown sequence completed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+import logging
+
+from database import get_city_by_alias, save_city
+from weather_api import geocode_city, normalize_city
+
+logger = logging.getLogger(__name__)
+
+
+class CityRegistry:
+    """
+    Сопоставляет пользовательские написания города («Москва», «москва », «Moscow»)
+    с городом OpenWeather (id, координаты, UTC-смещение).
+    Порядок поиска: память -> таблица city_aliases -> геокодинг через OpenWeather.
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._by_alias: dict[str, dict] = {}
+
+    def attach(self, pool) -> None:
+        self._pool = pool
+
+    async def resolve(self, name: str) -> dict | None:
+        """Город по названию или None, если OpenWeather его не знает."""
+        alias = normalize_city(name)
+        if not alias:
+            return None
+        city = self._by_alias.get(alias)
+        if city is not None:
+            return city
+
+        if self._pool is not None:
+            row = await get_city_by_alias(self._pool, alias)
+            if row is not None:
+                city = dict(row)
+                self._by_alias[alias] = city
+                return city
+
+        city = await geocode_city(name)
+        if city is None:
+            return None
+        self._by_alias[alias] = city
+        if self._pool is not None:
+            try:
+                await save_city(self._pool, city, alias)
+            except Exception as e:
+                logger.error(f"CityRegistry: can't save city {city['id']} for alias '{alias}': {e}")
+        return city
+
+    async def resolve_id(self, name: str) -> int | None:
+        try:
+            city = await self.resolve(name)
+        except Exception as e:
+            logger.warning(f"CityRegistry: can't resolve '{name}': {e}")
+            return None
+        return city["id"] if city else None
@@ -1,10 +1,16 @@
 import os
+import asyncio
+import contextlib
+import time
+from typing import Awaitable, Callable
 from dotenv import load_dotenv
 import asyncpg
 import datetime
 import logging
 import pytz
 
+from metrics import DB_ACQUIRE_SECONDS, DB_QUERY_SECONDS
+
 # Загружаем переменные окружения из файла .env
 load_dotenv()
 
@@ -15,8 +21,8 @@ logger = logging.getLogger(__name__)
 ALLOWED_ALERT_FIELDS = {"last_alert_sent_at", "last_precip_alert_at"}
 
 # Создание пула соединений с базой данных PostgreSQL
-async def get_pool():
-    return await asyncpg.create_pool(
+def _connection_params() -> dict:
+    return dict(
         user=os.getenv("POSTGRES_USER"),
         password=os.getenv("POSTGRES_PASSWORD"),
         database=os.getenv("POSTGRES_DB"),
@@ -26,17 +32,284 @@ async def get_pool():
         statement_cache_size=0  # Отключение кэширования SQL-запросов (можно настроить при необходимости)
     )
 
+async def get_pool():
+    return await asyncpg.create_pool(**_connection_params())
+
+# Отдельное соединение вне пула — для сессионных advisory-блокировок (выбор лидера)
+async def get_connection():
+    return await asyncpg.connect(**_connection_params())
+
+# Соединение из пула с замером ожидания в пуле и времени работы функции (метрики /metrics)
+@contextlib.asynccontextmanager
+async def _acquire(pool, function: str):
+    started = time.perf_counter()
+    async with pool.acquire() as conn:
+        acquired = time.perf_counter()
+        DB_ACQUIRE_SECONDS.labels(function).observe(acquired - started)
+        try:
+            yield conn
+        finally:
+            DB_QUERY_SECONDS.labels(function).observe(time.perf_counter() - acquired)
+
+# Идемпотентные миграции схемы, выполняются при старте приложения
+SCHEMA_MIGRATIONS = (
+    "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS next_daily_fire_at TIMESTAMPTZ",
+    # индекс по next_daily_fire_at не нужен: рассылку планирует колесо в памяти, запросов по этому полю нет
+    "DROP INDEX IF EXISTS subscriptions_next_daily_fire_idx",
+    # Состояния FSM aiogram (см. pg_storage.PostgresStorage)
+    """
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        storage_key TEXT PRIMARY KEY,
+        state TEXT,
+        data BYTEA,
+        expires_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS fsm_storage_expires_idx ON fsm_storage (expires_at)",
+    # Шардирование рассылок между воркерами (см. sharding.ShardLeaseManager)
+    """
+    CREATE TABLE IF NOT EXISTS scheduler_workers (
+        worker_id TEXT PRIMARY KEY,
+        heartbeat_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scheduler_shard_leases (
+        shard_id INT PRIMARY KEY,
+        owner TEXT,
+        expires_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    # Исходящие уведомления (transactional outbox, см. outbox.OutboxRelay)
+    """
+    CREATE TABLE IF NOT EXISTS notification_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        user_id BIGINT NOT NULL,
+        city TEXT NOT NULL,
+        text TEXT NOT NULL,
+        dedupe_key TEXT NOT NULL UNIQUE,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INT NOT NULL DEFAULT 0,
+        available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        locked_until TIMESTAMPTZ,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        sent_at TIMESTAMPTZ
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS notification_outbox_pending_idx
+        ON notification_outbox (available_at) WHERE status IN ('pending', 'sending')
+    """,
+    # После expires_at уведомление уже неактуально (утренний прогноз к вечеру, прошедший дождь) и не отправляется
+    "ALTER TABLE notification_outbox ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ",
+    # Справочник городов OpenWeather (см. city_registry.CityRegistry)
+    """
+    CREATE TABLE IF NOT EXISTS cities (
+        id BIGINT PRIMARY KEY,
+        name TEXT NOT NULL,
+        country TEXT,
+        lat DOUBLE PRECISION NOT NULL,
+        lon DOUBLE PRECISION NOT NULL,
+        utc_offset INT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS city_aliases (
+        alias TEXT PRIMARY KEY,
+        city_id BIGINT NOT NULL REFERENCES cities (id)
+    )
+    """,
+    "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS city_id BIGINT REFERENCES cities (id)",
+    "CREATE INDEX IF NOT EXISTS subscriptions_city_id_idx ON subscriptions (city_id) WHERE is_active",
+)
+
+async def ensure_schema(pool):
+    async with _acquire(pool, "ensure_schema") as conn:
+        for statement in SCHEMA_MIGRATIONS:
+            await conn.execute(statement)
+    # Заполняем время следующей отправки для старых подписок
+    await recompute_next_daily_fire_times(pool, only_missing=True)
+
+
+def compute_next_daily_fire(notification_time: datetime.time, timezone: str,
+                            after_utc: datetime.datetime) -> datetime.datetime:
+    """
+    Ближайший момент (UTC) после after_utc, когда в поясе timezone наступает notification_time.
+    Учитывает переходы на летнее/зимнее время на конкретную дату.
+    """
+    user_tz = pytz.timezone(timezone)
+    local_date = after_utc.astimezone(user_tz).date()
+    for day_offset in range(3):
+        naive = datetime.datetime.combine(local_date + datetime.timedelta(days=day_offset), notification_time)
+        # is_dst=False: несуществующее время (перевод вперёд) сдвигается вперёд, неоднозначное — берём зимнее
+        local_dt = user_tz.normalize(user_tz.localize(naive, is_dst=False))
+        fire_utc = local_dt.astimezone(pytz.utc).replace(microsecond=0)
+        if fire_utc > after_utc:
+            return fire_utc
+    raise ValueError(f"Could not compute next fire time for {notification_time} {timezone}")
+
+
+async def _set_next_daily_fire_times(conn, rows):
+    # rows: [(user_id, city, next_daily_fire_at), ...] — одним запросом
+    if not rows:
+        return
+    user_ids, cities, fire_times = zip(*rows)
+    await conn.execute("""
+        UPDATE subscriptions AS s
+        SET next_daily_fire_at = v.next_daily_fire_at
+        FROM unnest($1::BIGINT[], $2::TEXT[], $3::TIMESTAMPTZ[]) AS v(user_id, city, next_daily_fire_at)
+        WHERE s.user_id = v.user_id AND s.city = v.city;
+    """, list(user_ids), list(cities), list(fire_times))
+
+
+async def _advance_next_daily_fire_times(conn, rows) -> set[tuple]:
+    # rows: [(user_id, city, expected_fire_at, next_daily_fire_at), ...]. Сдвигает только активные подписки,
+    # у которых в БД всё ещё expected_fire_at; возвращает их ключи (user_id, city)
+    if not rows:
+        return set()
+    user_ids, cities, expected_times, next_times = (list(column) for column in zip(*rows))
+    confirmed = await conn.fetch("""
+        UPDATE subscriptions AS s
+        SET next_daily_fire_at = v.next_daily_fire_at
+        FROM unnest($1::BIGINT[], $2::TEXT[], $3::TIMESTAMPTZ[], $4::TIMESTAMPTZ[])
+             AS v(user_id, city, expected_fire_at, next_daily_fire_at)
+        WHERE s.user_id = v.user_id AND s.city = v.city
+          AND s.is_active = TRUE AND s.next_daily_fire_at = v.expected_fire_at
+        RETURNING s.user_id, s.city;
+    """, user_ids, cities, expected_times, next_times)
+    return {(row["user_id"], row["city"]) for row in confirmed}
+
+
+async def reschedule_next_daily_fire_times(pool, rows) -> set[tuple]:
+    """
+    Переносит next_daily_fire_at подписок из колеса этого процесса (например, после перехода
+    на летнее время). rows: [(user_id, city, прежний fire_at, новый fire_at), ...].
+    Подписки, изменённые с тех пор в другом месте, не трогаются. Возвращает перенесённые ключи.
+    """
+    async with _acquire(pool, "reschedule_next_daily_fire_times") as conn:
+        return await _advance_next_daily_fire_times(conn, rows)
+
+
+async def recompute_next_daily_fire_times(pool, only_missing: bool = False) -> int:
+    """Пересчитывает next_daily_fire_at (для всех активных подписок или только пустые)."""
+    now_utc = datetime.datetime.now(pytz.utc)
+    conditions = ["is_active = TRUE", "notification_time IS NOT NULL"]
+    if only_missing:
+        conditions.append("next_daily_fire_at IS NULL")
+
+    async with _acquire(pool, "recompute_next_daily_fire_times") as conn:
+        rows = await conn.fetch(
+            f"SELECT user_id, city, notification_time, timezone FROM subscriptions WHERE {' AND '.join(conditions)}"
+        )
+        updates = []
+        for row in rows:
+            try:
+                fire_at = compute_next_daily_fire(row["notification_time"], row["timezone"] or "UTC", now_utc)
+            except pytz.UnknownTimeZoneError:
+                logger.error(f"Unknown timezone {row['timezone']} for user {row['user_id']}, city {row['city']}")
+                continue
+            updates.append((row["user_id"], row["city"], fire_at))
+        await _set_next_daily_fire_times(conn, updates)
+    return len(updates)
+
+
+async def get_active_timezones(pool):
+    async with _acquire(pool, "get_active_timezones") as conn:
+        rows = await conn.fetch("""
+            SELECT DISTINCT COALESCE(timezone, 'UTC') AS timezone FROM subscriptions
+            WHERE is_active = TRUE;
+        """)
+        return [row["timezone"] for row in rows]
+
 # Сохраняем запрос пользователя к погоде в таблицу
 async def save_request(pool, username, city, dt):
-    async with pool.acquire() as connection:
+    async with _acquire(pool, "save_request") as connection:
         await connection.execute(
             "INSERT INTO weather_requests (username, city, request_time) VALUES ($1, $2, $3)",
             username, city, dt
         )
 
+HISTORY_QUEUE_MAX = int(os.getenv("HISTORY_QUEUE_MAX", "10000"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2"))
+
+
+class HistoryWriter:
+    """
+    Фоновая запись истории запросов (weather_requests): строки копятся в очереди
+    и сбрасываются через COPY по размеру пачки или по таймеру.
+    Очередь ограничена HISTORY_QUEUE_MAX: при переполнении (БД не успевает или недоступна)
+    новые строки отбрасываются и считаются в dropped, а не тормозят хендлеры —
+    история вспомогательная, ответ пользователю важнее. Других производителей у очереди нет.
+    """
+
+    def __init__(self, max_queue: int = HISTORY_QUEUE_MAX, batch_size: int = HISTORY_BATCH_SIZE,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL):
+        self._queue: asyncio.Queue[tuple] = asyncio.Queue(maxsize=max_queue)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._flush_now = asyncio.Event()
+        self._pool = None
+        self._task: asyncio.Task | None = None
+        self.dropped = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self, pool) -> None:
+        self._pool = pool
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="history-writer")
+
+    def submit(self, username: str, city: str, dt: datetime.datetime) -> bool:
+        """Никогда не ждёт. При переполнении очереди строка отбрасывается (см. docstring класса)."""
+        try:
+            self._queue.put_nowait((username, city, dt))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"HistoryWriter: queue is full, dropped {self.dropped} rows so far")
+            self._flush_now.set()
+            return False
+        if self._queue.qsize() >= self._batch_size:
+            self._flush_now.set()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        while not self._queue.empty():
+            rows = [self._queue.get_nowait() for _ in range(min(self._batch_size, self._queue.qsize()))]
+            try:
+                async with _acquire(self._pool, "HistoryWriter.flush") as conn:
+                    await conn.copy_records_to_table(
+                        "weather_requests", records=rows, columns=["username", "city", "request_time"]
+                    )
+            except Exception as e:
+                logger.error(f"HistoryWriter: failed to write {len(rows)} rows: {e}", exc_info=True)
+                return
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pool is not None:
+            await self.flush()
+
 # Получаем историю последних 10 запросов пользователя
 async def get_history(pool, username):
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_history") as conn:
         rows = await conn.fetch("""
             SELECT city, request_time FROM weather_requests
             WHERE username = $1
@@ -45,7 +318,8 @@ async def get_history(pool, username):
         """, username)
         return rows
 
-async def add_subscription(pool, user_id: int, city: str, notification_time_str: str = "08:00:00", timezone: str = "UTC"):
+async def add_subscription(pool, user_id: int, city: str, notification_time_str: str = "08:00:00", timezone: str = "UTC",
+                           city_id: int | None = None):
     # Преобразуем строку времени в объект datetime.time
     try:
         time_parts = list(map(int, notification_time_str.split(':')))
@@ -54,19 +328,28 @@ async def add_subscription(pool, user_id: int, city: str, notification_time_str:
         logger.error(f"Invalid time string format for notification_time: {notification_time_str}")
         raise ValueError(f"Invalid time format: {notification_time_str}. Expected HH:MM:SS or HH:MM")
 
+    try:
+        next_fire_at = compute_next_daily_fire(time_obj, timezone, datetime.datetime.now(pytz.utc))
+    except pytz.UnknownTimeZoneError:
+        logger.error(f"Unknown timezone for subscription: {timezone}")
+        raise ValueError(f"Unknown timezone: {timezone}")
 
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO subscriptions (user_id, city, notification_time, timezone, is_active)
-            VALUES ($1, $2, $3, $4, TRUE) -- Убираем ::TIME, так как передаем уже объект datetime.time
+    async with _acquire(pool, "add_subscription") as conn:
+        # Возвращаем строку подписки, чтобы вызывающий мог обновить расписание в памяти
+        return await conn.fetchrow("""
+            INSERT INTO subscriptions (user_id, city, notification_time, timezone, is_active, next_daily_fire_at, city_id)
+            VALUES ($1, $2, $3, $4, TRUE, $5, $6) -- Убираем ::TIME, так как передаем уже объект datetime.time
             ON CONFLICT (user_id, city) DO UPDATE
             SET notification_time = EXCLUDED.notification_time,
                 timezone = EXCLUDED.timezone,
-                is_active = TRUE;
-        """, user_id, city, time_obj, timezone)
+                is_active = TRUE,
+                next_daily_fire_at = EXCLUDED.next_daily_fire_at,
+                city_id = COALESCE(EXCLUDED.city_id, subscriptions.city_id)
+            RETURNING user_id, city, notification_time, timezone, next_daily_fire_at, city_id;
+        """, user_id, city, time_obj, timezone, next_fire_at, city_id)
 
 async def remove_subscription(pool, user_id: int, city: str):
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "remove_subscription") as conn:
         # Деактивируем подписку, а не удаляем, чтобы сохранить историю
         await conn.execute("""
             UPDATE subscriptions SET is_active = FALSE
@@ -74,33 +357,33 @@ async def remove_subscription(pool, user_id: int, city: str):
         """, user_id, city)
 
 async def get_user_subscriptions(pool, user_id: int):
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_user_subscriptions") as conn:
         rows = await conn.fetch("""
             SELECT city, notification_time, timezone FROM subscriptions
             WHERE user_id = $1 AND is_active = TRUE;
         """, user_id)
         return rows
 
-async def get_active_subscriptions_for_notification(pool, current_utc_time_str: str):
-    #Получает подписки, для которых пришло время уведомления.
-    #Сравнивает время без учета даты.
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT user_id, city FROM subscriptions
-            WHERE is_active = TRUE AND notification_time = $1::TIME;
-        """, current_utc_time_str)
-        return rows
-
 async def get_all_active_subscriptions_with_details(pool):
     """Получает все активные подписки с их деталями."""
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "get_all_active_subscriptions_with_details") as conn:
         # Добавляем выборку last_alert_sent_at
         rows = await conn.fetch("""
-            SELECT user_id, city, notification_time, timezone, last_alert_sent_at FROM subscriptions
+            SELECT user_id, city, city_id, notification_time, timezone, last_alert_sent_at, next_daily_fire_at
+            FROM subscriptions
             WHERE is_active = TRUE;
         """)
         return rows
 
+async def get_active_subscriptions_for_cities(pool, city_ids, city_names):
+    """Активные подписки на указанные города: по id OpenWeather, а у подписок без id — по названию."""
+    async with _acquire(pool, "get_active_subscriptions_for_cities") as conn:
+        return await conn.fetch("""
+            SELECT user_id, city, city_id FROM subscriptions
+            WHERE is_active = TRUE
+              AND (city_id = ANY($1::BIGINT[]) OR (city_id IS NULL AND city = ANY($2::TEXT[])));
+        """, list(city_ids), list(city_names))
+
 async def update_last_alert_time(
     pool,
     user_id: int,
@@ -113,7 +396,7 @@ async def update_last_alert_time(
 
     ts = timestamp or datetime.datetime.now(pytz.utc)
 
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "update_last_alert_time") as conn:
         await conn.execute(
             f"""
             UPDATE subscriptions
@@ -131,6 +414,285 @@ async def update_last_daily_sent_time(pool, user_id: int, city: str, dt: datetim
         SET last_daily_sent_at = $3
         WHERE user_id = $1 AND city = $2;
     """
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "update_last_daily_sent_time") as conn:
         await conn.execute(query, user_id, city, dt)
 
+
+class BatchWriter:
+    """
+    Копит строки в памяти и записывает их одной пачкой через flush_func:
+    как только набралось max_batch строк или прошло max_delay секунд с первой строки.
+    Если запись не удалась, строки остаются в буфере и повторяются через max_delay;
+    при долгом сбое хранится не больше max_buffer строк, самые старые отбрасываются.
+    """
+
+    def __init__(self, name: str, flush_func: Callable[[list], Awaitable[None]],
+                 max_batch: int = 500, max_delay: float = 2.0, max_buffer: int = 50_000):
+        self.name = name
+        self._flush_func = flush_func
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._max_buffer = max_buffer
+        self._buffer: list = []
+        self._timer: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._pending: set[asyncio.Task] = set()
+        self._closed = False
+
+    def add(self, row) -> None:
+        self._buffer.append(row)
+        if len(self._buffer) >= self._max_batch:
+            self._spawn(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._flush_later())
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._max_delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            rows, self._buffer = self._buffer, []
+            try:
+                await self._flush_func(rows)
+                logger.debug(f"BatchWriter[{self.name}]: flushed {len(rows)} rows")
+            except Exception as e:
+                logger.error(f"BatchWriter[{self.name}]: failed to flush {len(rows)} rows, will retry: {e}",
+                             exc_info=True)
+                # возвращаем строки в начало буфера (порядок сохраняется) и повторяем позже
+                self._buffer[:0] = rows
+                overflow = len(self._buffer) - self._max_buffer
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    logger.error(f"BatchWriter[{self.name}]: buffer full, dropped {overflow} oldest rows")
+                if self._closed:
+                    logger.error(f"BatchWriter[{self.name}]: closed, {len(self._buffer)} rows not written")
+                elif self._timer is None or self._timer.done() or self._timer is asyncio.current_task():
+                    self._timer = self._spawn(self._flush_later())
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        await self.flush()
+
+
+# --- Справочник городов ---
+async def get_city_by_alias(pool, alias: str):
+    async with _acquire(pool, "get_city_by_alias") as conn:
+        return await conn.fetchrow("""
+            SELECT c.id, c.name, c.country, c.lat, c.lon, c.utc_offset
+            FROM city_aliases a JOIN cities c ON c.id = a.city_id
+            WHERE a.alias = $1;
+        """, alias)
+
+
+async def save_city(pool, city: dict, alias: str):
+    # city: {"id", "name", "country", "lat", "lon", "utc_offset"} из weather_api.geocode_city
+    async with _acquire(pool, "save_city") as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO cities (id, name, country, lat, lon, utc_offset, updated_at)
+                VALUES ($1, $2, $3, $4, $5, $6, now())
+                ON CONFLICT (id) DO UPDATE
+                SET name = EXCLUDED.name, country = EXCLUDED.country, lat = EXCLUDED.lat,
+                    lon = EXCLUDED.lon, utc_offset = EXCLUDED.utc_offset, updated_at = now();
+            """, city["id"], city["name"], city["country"], city["lat"], city["lon"], city["utc_offset"])
+            await conn.execute("""
+                INSERT INTO city_aliases (alias, city_id) VALUES ($1, $2)
+                ON CONFLICT (alias) DO UPDATE SET city_id = EXCLUDED.city_id;
+            """, alias, city["id"])
+
+
+async def get_subscription_cities_without_id(pool):
+    async with _acquire(pool, "get_subscription_cities_without_id") as conn:
+        rows = await conn.fetch("""
+            SELECT DISTINCT city FROM subscriptions WHERE is_active = TRUE AND city_id IS NULL;
+        """)
+        return [row["city"] for row in rows]
+
+
+async def set_subscription_city_ids(pool, rows):
+    # rows: [(city, city_id), ...]
+    if not rows:
+        return
+    cities, city_ids = zip(*rows)
+    async with _acquire(pool, "set_subscription_city_ids") as conn:
+        await conn.execute("""
+            UPDATE subscriptions AS s SET city_id = v.city_id
+            FROM unnest($1::TEXT[], $2::BIGINT[]) AS v(city, city_id)
+            WHERE s.city = v.city AND s.city_id IS NULL;
+        """, list(cities), list(city_ids))
+
+
+# --- Outbox уведомлений ---
+# kind: 'daily' (утренний прогноз) или 'alert' (предупреждения о погоде; 'precipitation' — старые записи)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "3"))
+# Сколько секунд уведомление каждого вида остаётся актуальным после постановки в очередь
+OUTBOX_TTL = {
+    "daily": float(os.getenv("OUTBOX_DAILY_TTL", "7200")),
+    "alert": float(os.getenv("OUTBOX_ALERT_TTL", "3600")),
+}
+
+
+async def _insert_outbox(conn, notifications):
+    # notifications: [(kind, user_id, city, text, dedupe_key), ...]; повтор по dedupe_key игнорируется.
+    # expires_at — по OUTBOX_TTL вида; для видов без TTL NULL (не устаревает)
+    if not notifications:
+        return
+    kinds, user_ids, cities, texts, keys = zip(*notifications)
+    ttls = [OUTBOX_TTL.get(kind) for kind in kinds]
+    await conn.execute("""
+        INSERT INTO notification_outbox (kind, user_id, city, text, dedupe_key, expires_at)
+        SELECT v.kind, v.user_id, v.city, v.text, v.dedupe_key, now() + make_interval(secs => v.ttl)
+        FROM unnest($1::TEXT[], $2::BIGINT[], $3::TEXT[], $4::TEXT[], $5::TEXT[], $6::FLOAT8[])
+            AS v(kind, user_id, city, text, dedupe_key, ttl)
+        ON CONFLICT (dedupe_key) DO NOTHING;
+    """, list(kinds), list(user_ids), list(cities), list(texts), list(keys), ttls)
+
+
+async def enqueue_notifications(pool, notifications):
+    """Кладёт уведомления в outbox одной транзакцией: либо все, либо ни одного."""
+    async with _acquire(pool, "enqueue_notifications") as conn:
+        async with conn.transaction():
+            await _insert_outbox(conn, notifications)
+
+
+async def enqueue_daily_notifications(pool, notifications, fire_updates):
+    """
+    Утренняя рассылка тика одной транзакцией. fire_updates: [(user_id, city, fired_at, next_fire_at), ...].
+    next_daily_fire_at сдвигается только у подписок, которые всё ещё активны и в БД ждут именно fired_at:
+    подписку могли изменить или удалить на другой реплике, а колесо этого процесса об этом не знает.
+    Уведомления кладутся в outbox только для подтверждённых подписок.
+    Возвращает (подтверждённые ключи (user_id, city), актуальные строки неподтверждённых активных подписок).
+    """
+    if not fire_updates:
+        return set(), []
+    async with _acquire(pool, "enqueue_daily_notifications") as conn:
+        async with conn.transaction():
+            confirmed = await _advance_next_daily_fire_times(conn, fire_updates)
+            await _insert_outbox(conn, [n for n in notifications if (n[1], n[2]) in confirmed])
+
+            stale = [(row[0], row[1]) for row in fire_updates if (row[0], row[1]) not in confirmed]
+            current_rows = []
+            if stale:
+                stale_user_ids, stale_cities = zip(*stale)
+                current_rows = await conn.fetch("""
+                    SELECT s.user_id, s.city, s.city_id, s.notification_time, s.timezone,
+                           s.last_alert_sent_at, s.next_daily_fire_at
+                    FROM subscriptions AS s
+                    JOIN unnest($1::BIGINT[], $2::TEXT[]) AS v(user_id, city)
+                      ON s.user_id = v.user_id AND s.city = v.city
+                    WHERE s.is_active = TRUE;
+                """, list(stale_user_ids), list(stale_cities))
+    return confirmed, current_rows
+
+
+async def claim_outbox_batch(pool, limit: int, lease: datetime.timedelta, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+    """
+    Забирает пачку готовых к отправке уведомлений; параллельные воркеры не мешают друг другу (SKIP LOCKED).
+    Устаревшие (expires_at) и брошенные упавшим воркером после max_attempts попыток помечаются 'failed'.
+    """
+    async with _acquire(pool, "claim_outbox_batch") as conn:
+        async with conn.transaction():
+            expired = await conn.execute("""
+                UPDATE notification_outbox
+                SET status = 'failed', locked_until = NULL
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    WHERE (status = 'pending' AND expires_at <= now())
+                       OR (status = 'sending' AND locked_until <= now()
+                           AND (attempts >= $2 OR expires_at <= now()))
+                    ORDER BY id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                );
+            """, limit, max_attempts)
+            expired_count = int(expired.split()[-1])
+            if expired_count:
+                logger.warning(f"claim_outbox_batch: {expired_count} notifications expired or out of attempts")
+            return await conn.fetch("""
+                UPDATE notification_outbox
+                SET status = 'sending', attempts = attempts + 1, locked_until = now() + $2::INTERVAL
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    WHERE ((status = 'pending' AND available_at <= now())
+                           -- воркер упал посреди отправки
+                           OR (status = 'sending' AND locked_until <= now() AND attempts < $3))
+                      AND (expires_at IS NULL OR expires_at > now())
+                    ORDER BY id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, kind, user_id, city, text, attempts;
+            """, limit, lease, max_attempts)
+
+
+async def mark_outbox_sent(pool, rows):
+    # rows: [(outbox_id, attempts, sent_at), ...]; заодно фиксируем last_*_sent_at у подписок.
+    # attempts — номер попытки, с которым строка была забрана: строку, которую после истечения аренды
+    # забрал другой воркер, не трогаем
+    if not rows:
+        return
+    ids, attempts, timestamps = zip(*rows)
+    async with _acquire(pool, "mark_outbox_sent") as conn:
+        await conn.execute("""
+            WITH done AS (
+                UPDATE notification_outbox AS o
+                SET status = 'sent', sent_at = v.sent_at, locked_until = NULL
+                FROM unnest($1::BIGINT[], $2::INT[], $3::TIMESTAMPTZ[]) AS v(id, attempts, sent_at)
+                WHERE o.id = v.id AND o.attempts = v.attempts AND o.status = 'sending'
+                RETURNING o.kind, o.user_id, o.city, v.sent_at
+            ), per_sub AS (
+                SELECT user_id, city,
+                       max(sent_at) FILTER (WHERE kind = 'daily') AS daily_at,
+                       max(sent_at) FILTER (WHERE kind IN ('alert', 'precipitation')) AS alert_at
+                FROM done GROUP BY user_id, city
+            )
+            UPDATE subscriptions AS s
+            SET last_daily_sent_at = COALESCE(p.daily_at, s.last_daily_sent_at),
+                last_alert_sent_at = COALESCE(p.alert_at, s.last_alert_sent_at)
+            FROM per_sub AS p
+            WHERE s.user_id = p.user_id AND s.city = p.city;
+        """, list(ids), list(attempts), list(timestamps))
+
+
+async def mark_outbox_failed(pool, rows, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+    # rows: [(outbox_id, attempts), ...]. Неудачные — обратно в очередь с задержкой,
+    # после max_attempts попыток — 'failed'
+    if not rows:
+        return
+    ids, attempts = zip(*rows)
+    async with _acquire(pool, "mark_outbox_failed") as conn:
+        await conn.execute("""
+            UPDATE notification_outbox AS o
+            SET status = CASE WHEN o.attempts >= $3 THEN 'failed' ELSE 'pending' END,
+                available_at = now() + make_interval(secs => 60 * o.attempts),
+                locked_until = NULL
+            FROM unnest($1::BIGINT[], $2::INT[]) AS v(id, attempts)
+            WHERE o.id = v.id AND o.attempts = v.attempts AND o.status = 'sending';
+        """, list(ids), list(attempts), max_attempts)
+
+
+async def get_outbox_backlog(pool) -> int:
+    async with _acquire(pool, "get_outbox_backlog") as conn:
+        return await conn.fetchval("""
+            SELECT count(*) FROM notification_outbox WHERE status IN ('pending', 'sending');
+        """)
+
+
+async def purge_sent_outbox(pool, older_than: datetime.timedelta) -> int:
+    async with _acquire(pool, "purge_sent_outbox") as conn:
+        result = await conn.execute("""
+            DELETE FROM notification_outbox
+            WHERE status IN ('sent', 'failed') AND created_at < now() - $1::INTERVAL;
+        """, older_than)
+    return int(result.split()[-1])
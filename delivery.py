@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from metrics import MESSAGES
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "16"))
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "25"))      # сообщений/сек на весь бот
+DELIVERY_PER_CHAT_INTERVAL = float(os.getenv("DELIVERY_PER_CHAT_INTERVAL", "1"))  # секунд между сообщениями в один чат
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "3"))
+DELIVERY_BACKOFF_BASE = float(os.getenv("DELIVERY_BACKOFF_BASE", "1"))
+
+
+class OutgoingMessage:
+    __slots__ = ("chat_id", "text", "on_sent", "on_failed", "deadline")
+
+    def __init__(self, chat_id: int, text: str,
+                 on_sent: Callable[[], Awaitable[None]] | None = None,
+                 on_failed: Callable[[], Awaitable[None]] | None = None,
+                 deadline: float | None = None):
+        self.chat_id = chat_id
+        self.text = text
+        # вызываются после успешной / окончательно неудачной отправки
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        # time.monotonic(), после которого сообщение уже не отправляется (истекла аренда строки outbox)
+        self.deadline = deadline
+
+
+class DeliveryBatch:
+    """Одна рассылка: считает отправленные/неудачные сообщения и пишет итог в лог."""
+
+    def __init__(self, job_name: str, total: int):
+        self.job_name = job_name
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.expired = 0
+        self.started_at = time.monotonic()
+        self.done = asyncio.Event()
+        if total == 0:
+            self.done.set()
+
+    def _mark(self, ok: bool | None) -> None:
+        # None — не отправлено: срок сообщения (deadline) истёк раньше, чем до него дошла очередь
+        if ok is None:
+            MESSAGES.labels(self.job_name, "expired").inc()
+            self.expired += 1
+        elif ok:
+            MESSAGES.labels(self.job_name, "sent").inc()
+            self.sent += 1
+        else:
+            MESSAGES.labels(self.job_name, "failed").inc()
+            self.failed += 1
+        if self.sent + self.failed + self.expired >= self.total:
+            elapsed = time.monotonic() - self.started_at
+            rate = self.sent / elapsed if elapsed > 0 else float(self.sent)
+            logger.info(f"Delivery[{self.job_name}]: {self.sent} sent, {self.failed} failed, {self.expired} expired "
+                        f"in {elapsed:.1f}s ({rate:.1f} msg/s)")
+            self.done.set()
+
+    async def wait(self) -> None:
+        await self.done.wait()
+
+
+class DeliveryPipeline:
+    """
+    Очередь исходящих сообщений Telegram с пулом воркеров, общим лимитом
+    сообщений в секунду, паузой между сообщениями в один чат и повторами
+    (RetryAfter, сетевые ошибки и 5xx).
+    """
+
+    def __init__(self, bot: Bot,
+                 workers: int = DELIVERY_WORKERS,
+                 global_rate: float = DELIVERY_GLOBAL_RATE,
+                 per_chat_interval: float = DELIVERY_PER_CHAT_INTERVAL,
+                 max_retries: int = DELIVERY_MAX_RETRIES):
+        self._bot = bot
+        self._workers_count = workers
+        self._bucket = TokenBucket(global_rate)
+        self._per_chat_interval = per_chat_interval
+        self._max_retries = max_retries
+        self._chat_ready_at: dict[int, float] = {}
+        self._queue: asyncio.Queue[tuple[OutgoingMessage, DeliveryBatch]] = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker(), name=f"delivery-{i}")
+                         for i in range(self._workers_count)]
+        logger.info(f"Delivery: started {self._workers_count} workers")
+
+    async def stop(self, drain_timeout: float = 10) -> None:
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Delivery: {self._queue.qsize()} messages left undelivered on shutdown")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Delivery: stopped")
+
+    def submit_batch(self, job_name: str, messages: list[OutgoingMessage]) -> DeliveryBatch:
+        batch = DeliveryBatch(job_name, len(messages))
+        for message in messages:
+            self._queue.put_nowait((message, batch))
+        if messages:
+            logger.info(f"Delivery[{job_name}]: queued {len(messages)} messages (queue depth {self._queue.qsize()})")
+        return batch
+
+    async def _worker(self) -> None:
+        while True:
+            message, batch = await self._queue.get()
+            try:
+                ok = await self._deliver(message, batch.job_name)
+            except Exception as e:
+                logger.error(f"Delivery[{batch.job_name}]: unexpected error for {message.chat_id}: {e}", exc_info=True)
+                ok = False
+            try:
+                callback = None if ok is None else message.on_sent if ok else message.on_failed
+                if callback is not None:
+                    await callback()
+            except Exception as e:
+                logger.error(f"Delivery[{batch.job_name}]: delivery callback failed: {e}", exc_info=True)
+            finally:
+                batch._mark(ok)
+                self._queue.task_done()
+
+    async def _wait_for_chat(self, chat_id: int) -> None:
+        now = time.monotonic()
+        ready_at = self._chat_ready_at.get(chat_id, 0.0)
+        self._chat_ready_at[chat_id] = max(now, ready_at) + self._per_chat_interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+        if len(self._chat_ready_at) > 50_000:
+            # чистим чаты, для которых пауза уже истекла
+            now = time.monotonic()
+            self._chat_ready_at = {k: v for k, v in self._chat_ready_at.items() if v > now}
+
+    async def _deliver(self, message: OutgoingMessage, job_name: str) -> bool | None:
+        attempt = 0
+        while True:
+            await self._wait_for_chat(message.chat_id)
+            await self._bucket.acquire()
+            if message.deadline is not None and time.monotonic() >= message.deadline:
+                logger.warning(f"Delivery[{job_name}]: message to {message.chat_id} expired before sending")
+                return None
+            try:
+                await self._bot.send_message(message.chat_id, message.text)
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать: притормаживаем всю рассылку и этот чат
+                logger.warning(f"Delivery[{job_name}]: RetryAfter {e.retry_after}s (chat {message.chat_id})")
+                self._bucket.pause(e.retry_after)
+                self._chat_ready_at[message.chat_id] = time.monotonic() + e.retry_after
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self._max_retries:
+                    logger.error(f"Delivery[{job_name}]: giving up on {message.chat_id} after {attempt + 1} attempts: {e}")
+                    return False
+                delay = DELIVERY_BACKOFF_BASE * 2 ** attempt
+                logger.warning(f"Delivery[{job_name}]: send to {message.chat_id} failed ({e}), retry in {delay:.0f}s")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                # блокировка бота пользователем, неверный chat_id и т.п. — повторять бессмысленно
+                logger.error(f"Delivery[{job_name}]: telegram send error for {message.chat_id}: {e}")
+                return False
+            else:
+                return True
+            attempt += 1
+            if attempt > self._max_retries:
+                logger.error(f"Delivery[{job_name}]: giving up on {message.chat_id} after {attempt} attempts")
+                return False
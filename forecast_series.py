@@ -0,0 +1,64 @@
+import bisect
+import itertools
+import time
+from array import array
+
+# Номер разбора: меняется при каждом обновлении прогноза (версия данных для кэша текстов)
+_versions = itertools.count(1)
+
+PRECIPITATION_CODES = {
+    # Drizzle
+    300, 301, 302, 310, 311, 312, 313, 314, 321,
+    # Rain
+    500, 501, 502, 503, 504, 511, 520, 521, 522, 531,
+    # Snow
+    600, 601, 602, 611, 612, 613, 615, 616, 620, 621, 622,
+    # Thunderstorm
+    200, 201, 202, 210, 211, 212, 221, 230, 231, 232
+}
+
+
+class ForecastSeries:
+    """
+    Прогноз OpenWeather (/forecast, шаг 3 часа), разобранный один раз в столбцы array:
+    время (epoch, UTC), код погоды, температура, ветер.
+    Занимает десятки байт на интервал вместо вложенных dict из JSON и позволяет
+    отвечать на запросы по окну времени бинарным поиском.
+    """
+    __slots__ = ("version", "received_at", "city_id", "utc_offset", "times", "codes", "temps", "winds", "descriptions")
+
+    def __init__(self, city_id: int | None, utc_offset: int | None):
+        self.version = next(_versions)
+        self.received_at = time.time()
+        self.city_id = city_id
+        self.utc_offset = utc_offset  # секунд относительно UTC (поле city.timezone)
+        self.times = array("q")
+        self.codes = array("H")
+        self.temps = array("f")
+        self.winds = array("f")
+        # код погоды -> описание; в прогнозе их единицы, поэтому не храним строку на каждый интервал
+        self.descriptions: dict[int, str] = {}
+
+    @classmethod
+    def from_response(cls, data: dict) -> "ForecastSeries":
+        city = data.get("city", {})
+        series = cls(city.get("id"), city.get("timezone"))
+        for item in sorted(data.get("list", []), key=lambda item: item["dt"]):
+            weather = (item.get("weather") or [{}])[0]
+            code = weather.get("id", 0)
+            series.times.append(item["dt"])
+            series.codes.append(code)
+            series.temps.append(item.get("main", {}).get("temp", 0.0))
+            series.winds.append(item.get("wind", {}).get("speed", 0.0))
+            series.descriptions.setdefault(code, weather.get("description", ""))
+        return series
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def window(self, start_ts: float, end_ts: float) -> tuple[int, int]:
+        """Индексы [lo, hi) интервалов с временем в [start_ts, end_ts]."""
+        return bisect.bisect_left(self.times, start_ts), bisect.bisect_right(self.times, end_ts)
+
+    def description(self, index: int) -> str:
+        return self.descriptions.get(self.codes[index], "")
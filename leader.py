@@ -0,0 +1,115 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+from collections import deque
+from typing import Awaitable, Callable
+
+import asyncpg
+import pytz
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LOCK_KEY = int(os.getenv("SCHEDULER_LOCK_KEY", "5749544850"))  # произвольный bigint, общий для всех реплик
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "5"))  # секунд
+
+
+class LeaderElector:
+    """
+    Выбор лидера через сессионную advisory-блокировку Postgres.
+    Блокировку держит отдельное соединение: если процесс-лидер падает, Postgres
+    закрывает его сессию и снимает блокировку, и другая реплика забирает её
+    на ближайшей проверке (через LEADER_CHECK_INTERVAL секунд).
+    Соединение должно идти напрямую в Postgres (не через pgbouncer в режиме transaction).
+    """
+
+    def __init__(self, connect: Callable[[], Awaitable[asyncpg.Connection]],
+                 on_elected: Callable[[], Awaitable[None]],
+                 on_demoted: Callable[[], Awaitable[None]],
+                 lock_key: int = SCHEDULER_LOCK_KEY,
+                 check_interval: float = LEADER_CHECK_INTERVAL):
+        self._connect = connect
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._lock_key = lock_key
+        self._check_interval = check_interval
+        self._conn = None
+        self._task: asyncio.Task | None = None
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self.since: datetime.datetime | None = None
+        self.transitions: deque = deque(maxlen=20)
+
+    def status(self) -> dict:
+        return {
+            "instance": self.instance_id,
+            "is_leader": self.is_leader,
+            "since": self.since.isoformat() if self.since else None,
+            "transitions": list(self.transitions),
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="leader-election")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._set_leader(False, "shutdown")
+        await self._close_connection()
+
+    async def _close_connection(self) -> None:
+        if self._conn is not None:
+            try:
+                await self._conn.close(timeout=5)
+            except Exception:
+                self._conn.terminate()
+            self._conn = None
+
+    async def _set_leader(self, is_leader: bool, reason: str) -> None:
+        self.is_leader = is_leader
+        self.since = datetime.datetime.now(pytz.utc)
+        self.transitions.append({"at": self.since.isoformat(), "is_leader": is_leader, "reason": reason})
+        if is_leader:
+            logger.warning(f"Leader: {self.instance_id} became scheduler leader ({reason})")
+            callback = self._on_elected
+        else:
+            logger.warning(f"Leader: {self.instance_id} lost scheduler leadership ({reason})")
+            callback = self._on_demoted
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Leader: leadership callback failed: {e}", exc_info=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Leader: election check failed: {e}")
+                if self.is_leader:
+                    await self._set_leader(False, f"lock connection lost: {e}")
+                await self._close_connection()
+            await asyncio.sleep(self._check_interval)
+
+    async def _check(self) -> None:
+        if self._conn is None or self._conn.is_closed():
+            if self.is_leader:
+                await self._set_leader(False, "lock connection closed")
+            self._conn = await self._connect()
+
+        if self.is_leader:
+            # держим блокировку, пока живо соединение
+            await self._conn.fetchval("SELECT 1", timeout=self._check_interval)
+            return
+
+        acquired = await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", self._lock_key,
+                                             timeout=self._check_interval)
+        if acquired:
+            await self._set_leader(True, "advisory lock acquired")
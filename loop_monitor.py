@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import LOOP_BLOCKS, LOOP_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))  # секунд между замерами
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.5"))    # секунд без ответа loop
+
+
+class LoopMonitor:
+    """
+    Следит за event loop:
+    - задача в loop каждые interval секунд засыпает и меряет, насколько позже проснулась (лаг);
+    - сторожевой поток замечает, что loop не отвечает дольше block_threshold, и пишет в лог
+      стек потока loop и текущую задачу — это и есть блокирующий вызов внутри корутины.
+    """
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, block_threshold: float = LOOP_BLOCK_THRESHOLD):
+        self._interval = interval
+        self._block_threshold = block_threshold
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+        self._last_beat = time.monotonic()
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure(), name="loop-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"LoopMonitor: started (block threshold {self._block_threshold}s)")
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join, self._block_threshold * 2)
+            self._watchdog = None
+
+    async def _measure(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self._interval)
+            now = time.monotonic()
+            self._last_beat = now
+            lag = max(now - started - self._interval, 0.0)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+    def _watch(self) -> None:
+        reported_beat = None
+        while not self._stopped.wait(self._block_threshold / 2):
+            beat = self._last_beat
+            blocked_for = time.monotonic() - beat
+            if blocked_for < self._block_threshold + self._interval or beat == reported_beat:
+                continue
+            reported_beat = beat  # одна запись на одну блокировку
+            LOOP_BLOCKS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no frame>"
+            task = asyncio.current_task(self._loop)
+            task_name = task.get_name() if task is not None else None
+            logger.warning(f"LoopMonitor: event loop blocked for {blocked_for:.2f}s+ in task {task_name}:\n{stack}")
@@ -0,0 +1,55 @@
+import os
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from metrics import cache_hit
+
+MESSAGE_CACHE_MAX_ENTRIES = int(os.getenv("MESSAGE_CACHE_MAX_ENTRIES", "10000"))
+
+
+class MessageCache:
+    """
+    Готовые тексты сообщений (LRU): (данные, версия данных, шаблон, метка) -> str.
+    «Данные» — ключ записи кэша погоды (эндпоинт + город); при обновлении этой записи
+    все тексты по ней удаляются через invalidate(). Метка — то, что отличает текст
+    у подписчиков одного города: написание города, время, часовой пояс.
+    """
+
+    def __init__(self, name: str = "messages", max_entries: int = MESSAGE_CACHE_MAX_ENTRIES):
+        self.name = name
+        self._max_entries = max_entries
+        self._texts: "OrderedDict[tuple, str]" = OrderedDict()
+        self._keys_by_data: dict[Hashable, set[tuple]] = {}
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def render(self, data_key: Hashable, version: Hashable, template: str, label: Hashable,
+               build: Callable[[], str]) -> str:
+        key = (data_key, version, template, label)
+        text = self._texts.get(key)
+        if text is not None:
+            cache_hit(self.name, True)
+            self._texts.move_to_end(key)
+            return text
+
+        cache_hit(self.name, False)
+        text = build()
+        self._texts[key] = text
+        self._keys_by_data.setdefault(data_key, set()).add(key)
+        while len(self._texts) > self._max_entries:
+            old_key, _ = self._texts.popitem(last=False)
+            self._forget(old_key)
+        return text
+
+    def invalidate(self, data_key: Hashable) -> None:
+        """Данные города обновились — старые тексты больше не нужны."""
+        for key in self._keys_by_data.pop(data_key, ()):
+            self._texts.pop(key, None)
+
+    def _forget(self, key: tuple) -> None:
+        keys = self._keys_by_data.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_data[key[0]]
@@ -0,0 +1,108 @@
+import datetime
+import logging
+import os
+import time
+
+import pytz
+from aiogram import BaseMiddleware
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# Хендлеры дольше этого порога пишутся в лог с именем и состоянием FSM
+HANDLER_SLOW_SECONDS = float(os.getenv("HANDLER_SLOW_SECONDS", "1"))
+
+# Границы корзин: от миллисекунд (кэш, БД) до десятков секунд (медленный OpenWeather, догоняющий тик)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+WEBHOOK_SECONDS = Histogram(
+    "weatherbot_webhook_seconds", "Время ответа на вебхук Telegram (разбор и постановка в очередь)",
+    buckets=LATENCY_BUCKETS)
+HANDLER_SECONDS = Histogram(
+    "weatherbot_handler_seconds", "Время обработки апдейта хендлером aiogram", ["handler", "state"],
+    buckets=LATENCY_BUCKETS)
+UPSTREAM_SECONDS = Histogram(
+    "weatherbot_openweather_seconds", "Время запроса к OpenWeather", ["endpoint", "status"],
+    buckets=LATENCY_BUCKETS)
+DB_ACQUIRE_SECONDS = Histogram(
+    "weatherbot_db_acquire_seconds", "Ожидание соединения из пула asyncpg", ["function"],
+    buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = Histogram(
+    "weatherbot_db_query_seconds", "Время работы с соединением (запросы функции database.py)", ["function"],
+    buckets=LATENCY_BUCKETS)
+JOB_SECONDS = Histogram(
+    "weatherbot_job_seconds", "Длительность задачи планировщика", ["job"],
+    buckets=LATENCY_BUCKETS)
+JOB_LAG_SECONDS = Histogram(
+    "weatherbot_job_lag_seconds", "Задержка запуска задачи относительно расписания", ["job"],
+    buckets=LATENCY_BUCKETS)
+JOB_RUNS = Counter("weatherbot_job_runs_total", "Запуски задач планировщика", ["job", "result"])
+MESSAGES = Counter("weatherbot_messages_total", "Сообщения рассылок", ["job", "result"])
+CACHE_REQUESTS = Counter("weatherbot_cache_requests_total", "Обращения к кэшам", ["cache", "result"])
+LOOP_LAG_SECONDS = Histogram(
+    "weatherbot_event_loop_lag_seconds", "Опоздание пробуждения задачи-замерщика в event loop",
+    buckets=LATENCY_BUCKETS)
+LOOP_BLOCKS = Counter("weatherbot_event_loop_blocks_total", "Блокировки event loop дольше LOOP_BLOCK_THRESHOLD")
+QUEUE_DEPTH = Gauge("weatherbot_queue_depth", "Длина внутренних очередей (wheel — подписок в колесе)", ["queue"])
+
+
+def render_latest() -> tuple[bytes, str]:
+    """Текущие метрики в текстовом формате Prometheus и их Content-Type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def cache_hit(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def cache_stale(cache: str) -> None:
+    """Отдали устаревшие данные (stale-while-revalidate)."""
+    CACHE_REQUESTS.labels(cache, "stale").inc()
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """
+    Middleware роутера: время каждого хендлера по имени функции и состоянию FSM,
+    медленные вызовы (дольше HANDLER_SLOW_SECONDS) — в лог. Регистрируется как
+    внутренний (router.message.middleware), т.к. хендлер известен только после фильтров.
+    """
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+            state = data.get("raw_state") or "none"
+            HANDLER_SECONDS.labels(name, state).observe(elapsed)
+            if elapsed >= HANDLER_SLOW_SECONDS:
+                user = getattr(event, "from_user", None)
+                logger.warning(f"Slow handler {name} (state {state}, user {user.id if user else None}): "
+                               f"{elapsed:.2f}s")
+
+
+def instrument_scheduler(scheduler) -> None:
+    """Длительность, задержка запуска и итог задач APScheduler по событиям планировщика."""
+    started: dict[str, float] = {}
+
+    def on_submitted(event) -> None:
+        started[event.job_id] = time.perf_counter()
+        if event.scheduled_run_times:
+            lag = datetime.datetime.now(pytz.utc) - max(event.scheduled_run_times)
+            JOB_LAG_SECONDS.labels(event.job_id).observe(max(lag.total_seconds(), 0))
+
+    def on_finished(event) -> None:
+        began = started.pop(event.job_id, None)
+        if began is not None:
+            JOB_SECONDS.labels(event.job_id).observe(time.perf_counter() - began)
+        JOB_RUNS.labels(event.job_id, "error" if event.exception else "ok").inc()
+
+    def on_missed(event) -> None:
+        JOB_RUNS.labels(event.job_id, "missed").inc()
+
+    scheduler.add_listener(on_submitted, EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(on_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+    scheduler.add_listener(on_missed, EVENT_JOB_MISSED)
@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+import pytz
+
+from database import BatchWriter, claim_outbox_batch, mark_outbox_failed, mark_outbox_sent
+from delivery import DeliveryPipeline, OutgoingMessage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))  # секунд
+OUTBOX_LEASE = datetime.timedelta(seconds=int(os.getenv("OUTBOX_LEASE", "120")))
+# за сколько секунд до конца аренды строка уже не отправляется (останется запас на сам запрос к Telegram)
+OUTBOX_LEASE_MARGIN = float(os.getenv("OUTBOX_LEASE_MARGIN", "30"))
+
+
+class OutboxRelay:
+    """
+    Забирает уведомления из notification_outbox (FOR UPDATE SKIP LOCKED) и передаёт их
+    в конвейер доставки. Результаты отправки записываются обратно пачками.
+    Запускается в одном процессе (см. api.py), чтобы лимит DELIVERY_GLOBAL_RATE был общим на весь бот.
+    Строка, аренда которой подходит к концу, не отправляется: её заберут заново, а пометка
+    об отправке совпадает со строкой только по номеру попытки, с которым её забрали.
+    """
+
+    def __init__(self, delivery: DeliveryPipeline, batch_size: int = OUTBOX_BATCH_SIZE,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL, lease: datetime.timedelta = OUTBOX_LEASE):
+        self._delivery = delivery
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease = lease
+        self._pool = None
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._sent_writer = BatchWriter("outbox_sent", lambda rows: mark_outbox_sent(self._pool, rows))
+        self._failed_writer = BatchWriter("outbox_failed", lambda rows: mark_outbox_failed(self._pool, rows))
+
+    def start(self, pool) -> None:
+        self._pool = pool
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="outbox-relay")
+
+    def wake(self) -> None:
+        """Сразу проверить outbox (вызывается после постановки новых уведомлений)."""
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def flush(self) -> None:
+        # Вызывается после остановки конвейера доставки: дописываем результаты
+        await self._sent_writer.close()
+        await self._failed_writer.close()
+
+    async def _run(self) -> None:
+        while True:
+            claimed = 0
+            try:
+                # не набираем больше, чем конвейер успеет отправить до истечения аренды
+                if self._delivery.queue_depth < self._batch_size:
+                    claimed = await self._relay_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox: relay failed: {e}", exc_info=True)
+            if claimed < self._batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _relay_batch(self) -> int:
+        # срок отсчитываем от момента до запроса: аренда в БД начинается не раньше
+        deadline = time.monotonic() + self._lease.total_seconds() - OUTBOX_LEASE_MARGIN
+        rows = await claim_outbox_batch(self._pool, self._batch_size, self._lease)
+        if not rows:
+            return 0
+        by_kind: dict[str, list[OutgoingMessage]] = {}
+        for row in rows:
+            by_kind.setdefault(row["kind"], []).append(
+                OutgoingMessage(row["user_id"], row["text"],
+                                on_sent=self._sent_callback(row["id"], row["attempts"]),
+                                on_failed=self._failed_callback(row["id"], row["attempts"]),
+                                deadline=deadline)
+            )
+        for kind, messages in by_kind.items():
+            self._delivery.submit_batch(kind, messages)
+        return len(rows)
+
+    def _sent_callback(self, outbox_id: int, attempts: int):
+        async def on_sent() -> None:
+            self._sent_writer.add((outbox_id, attempts, datetime.datetime.now(pytz.utc)))
+        return on_sent
+
+    def _failed_callback(self, outbox_id: int, attempts: int):
+        async def on_failed() -> None:
+            self._failed_writer.add((outbox_id, attempts))
+        return on_failed
@@ -0,0 +1,155 @@
+import datetime
+import json
+import logging
+import os
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import pytz
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))  # секунд хранения состояния
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "2"))  # секунд жизни записи в локальном кэше
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+_COMPRESS_THRESHOLD = 512  # байт; короче — храним JSON как есть
+
+
+def _encode_default(obj):
+    # Данные FSM содержат записи asyncpg и datetime.time из подписок
+    if isinstance(obj, datetime.datetime):
+        return {"__dt": obj.isoformat()}
+    if isinstance(obj, datetime.time):
+        return {"__t": obj.isoformat()}
+    if isinstance(obj, datetime.date):
+        return {"__d": obj.isoformat()}
+    if hasattr(obj, "items"):
+        return dict(obj.items())
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable for FSM storage")
+
+
+def _decode_hook(obj: dict):
+    if len(obj) == 1:
+        if "__dt" in obj:
+            return datetime.datetime.fromisoformat(obj["__dt"])
+        if "__t" in obj:
+            return datetime.time.fromisoformat(obj["__t"])
+        if "__d" in obj:
+            return datetime.date.fromisoformat(obj["__d"])
+    return obj
+
+
+def dump_data(data: Dict[str, Any]) -> bytes:
+    raw = json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=_encode_default).encode()
+    if len(raw) > _COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+
+def load_data(blob: bytes | None) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    blob = bytes(blob)
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return json.loads(raw, object_hook=_decode_hook)
+
+
+def _key_to_str(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в Postgres (таблица fsm_storage), общее для всех воркеров и реплик.
+    Перед БД стоит небольшой LRU-кэш чтения с коротким TTL. Записи истекают через FSM_STATE_TTL.
+    """
+
+    def __init__(self, state_ttl: int = FSM_STATE_TTL, cache_ttl: float = FSM_CACHE_TTL,
+                 cache_size: int = FSM_CACHE_SIZE):
+        self._pool = None
+        self._state_ttl = datetime.timedelta(seconds=state_ttl)
+        self._cache_ttl = cache_ttl
+        self._cache_size = cache_size
+        # storage_key -> (время кэширования, state, data)
+        self._cache: "OrderedDict[str, tuple[float, Optional[str], Dict[str, Any]]]" = OrderedDict()
+
+    def attach(self, pool) -> None:
+        self._pool = pool
+
+    def _cache_get(self, skey: str):
+        entry = self._cache.get(skey)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self._cache_ttl:
+            del self._cache[skey]
+            return None
+        self._cache.move_to_end(skey)
+        return entry
+
+    def _cache_put(self, skey: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        self._cache[skey] = (time.monotonic(), state, data)
+        self._cache.move_to_end(skey)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, skey: str):
+        entry = self._cache_get(skey)
+        if entry is not None:
+            return entry[1], entry[2]
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT state, data FROM fsm_storage
+                WHERE storage_key = $1 AND expires_at > now();
+            """, skey)
+        state, data = (row["state"], load_data(row["data"])) if row else (None, {})
+        self._cache_put(skey, state, data)
+        return state, data
+
+    def _expires_at(self) -> datetime.datetime:
+        return datetime.datetime.now(pytz.utc) + self._state_ttl
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = _key_to_str(key)
+        state = state.state if isinstance(state, State) else state
+        async with self._pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO fsm_storage (storage_key, state, expires_at) VALUES ($1, $2, $3)
+                ON CONFLICT (storage_key) DO UPDATE
+                SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at;
+            """, skey, state, self._expires_at())
+        cached = self._cache_get(skey)
+        if cached is not None:
+            self._cache_put(skey, state, cached[2])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(_key_to_str(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        skey = _key_to_str(key)
+        async with self._pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO fsm_storage (storage_key, data, expires_at) VALUES ($1, $2, $3)
+                ON CONFLICT (storage_key) DO UPDATE
+                SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at;
+            """, skey, dump_data(data) if data else None, self._expires_at())
+        cached = self._cache_get(skey)
+        if cached is not None:
+            self._cache_put(skey, cached[1], data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(_key_to_str(key))
+        return data.copy()
+
+    async def purge_expired(self) -> int:
+        async with self._pool.acquire() as conn:
+            result = await conn.execute("DELETE FROM fsm_storage WHERE expires_at <= now();")
+        # asyncpg возвращает статус вида "DELETE 42"
+        return int(result.split()[-1])
+
+    async def close(self) -> None:
+        self._cache.clear()
@@ -0,0 +1,50 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # секунд между снимками стека
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер потока event loop: отдельный поток каждые interval секунд
+    снимает стек потока loop через sys._current_frames() и считает одинаковые стеки.
+    Результат — collapsed stacks («корень;...;лист количество»), формат flamegraph.pl / speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self._interval = interval
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, thread_id: int, seconds: float) -> str:
+        """Блокирующий вызов: запускать в отдельном потоке (asyncio.to_thread)."""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("profiler is already running")
+        try:
+            stacks: collections.Counter[str] = collections.Counter()
+            deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is None:
+                    break
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                stacks[";".join(reversed(labels))] += 1
+                time.sleep(self._interval)
+        finally:
+            self._lock.release()
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity в запасе.
+    Ожидающие обслуживаются по очереди (FIFO) благодаря общему замку.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float) -> None:
+        """Никому не выдавать токены ближайшие seconds секунд (например, после RetryAfter / 429)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until or self._lock.locked():
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PriorityTokenBucket(TokenBucket):
+    """
+    Token bucket с приоритетами: при нехватке токенов ожидающие получают их
+    по возрастанию priority (0 — самый важный), внутри приоритета — по очереди.
+    Приоритет уже стоящего в очереди можно повысить (raise_priority).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        super().__init__(rate, capacity)
+        # записи heap — [priority, seq, future]; future=None — запись заменена при повышении приоритета
+        self._waiters: list[list] = []
+        self._entries: dict[asyncio.Future, list] = {}
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for future in self._entries if not future.done())
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until or self._waiters:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: int = 0) -> None:
+        if self.try_acquire():
+            return
+        await self.wait(self.enqueue(priority))
+
+    def enqueue(self, priority: int = 0) -> asyncio.Future:
+        """Встаёт в очередь за токеном; future завершится, когда токен выдан (сразу, если он есть)."""
+        future = asyncio.get_running_loop().create_future()
+        if self.try_acquire():
+            future.set_result(None)
+            return future
+        entry = [priority, next(self._seq), future]
+        self._entries[future] = entry
+        heapq.heappush(self._waiters, entry)
+        self._schedule()
+        return future
+
+    async def wait(self, future: asyncio.Future) -> None:
+        """Ждёт токен, за которым встали через enqueue()."""
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._tokens += 1  # токен выдан, но не использован — возвращаем
+            future.cancel()
+            self._entries.pop(future, None)
+            raise
+
+    def raise_priority(self, future: asyncio.Future, priority: int) -> None:
+        """Повышает приоритет ожидающего future (место в очереди внутри нового приоритета — по времени постановки)."""
+        entry = self._entries.get(future)
+        if entry is None or future.done() or entry[0] <= priority:
+            return
+        entry[2] = None
+        entry = [priority, entry[1], future]
+        self._entries[future] = entry
+        heapq.heappush(self._waiters, entry)
+
+    def _schedule(self) -> None:
+        if self._timer is not None or not self._waiters:
+            return
+        now = time.monotonic()
+        self._refill(now)
+        delay = max(self._paused_until - now, (1 - self._tokens) / self.rate, 0.0)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        now = time.monotonic()
+        if now >= self._paused_until:
+            self._refill(now)
+            while self._waiters and self._tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future is None or future.done():
+                    continue  # запись заменена или ожидающий отменён
+                del self._entries[future]
+                self._tokens -= 1
+                future.set_result(None)
+        while self._waiters and (self._waiters[0][2] is None or self._waiters[0][2].done()):
+            _, _, future = heapq.heappop(self._waiters)
+            if future is not None:
+                self._entries.pop(future, None)
+        self._schedule()
+
+
+class CircuitBreaker:
+    """
+    Размыкается после failure_threshold ошибок подряд и reset_timeout секунд не пропускает
+    запросы: wait() ждёт (или, с timeout, сразу сообщает об отказе). Затем пропускает один пробный запрос; успех замыкает цепь,
+    ошибка снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._open_until = 0.0
+        self._half_open = False
+        self._probe_done = asyncio.Event()
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if time.monotonic() < self._open_until:
+            return "open"
+        return "half_open" if self._half_open else "closed"
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """
+        Ждёт, пока цепь пропустит запрос. С timeout ждёт не дольше timeout секунд и возвращает
+        False, если запрос так и не пропущен (цепь разомкнута дольше или пробный запрос не завершился).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if now < self._open_until:
+                if deadline is not None and self._open_until > deadline:
+                    return False
+                await asyncio.sleep(self._open_until - now)
+                continue
+            if not self._half_open:
+                return True
+            if not self._probing:
+                self._probing = True
+                return True
+            if deadline is None:
+                await self._probe_done.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._probe_done.wait(), deadline - now)
+            except asyncio.TimeoutError:
+                return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._half_open = False
+        self._end_probe()
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._half_open or self._failures >= self._failure_threshold:
+            self._open_until = time.monotonic() + self._reset_timeout
+            self._half_open = True
+            self._failures = 0
+        self._end_probe()
+
+    def release(self) -> None:
+        """Запрос завершился без результата (отменён): пробу может сделать следующий."""
+        self._end_probe()
+
+    def _end_probe(self) -> None:
+        self._probing = False
+        self._probe_done.set()
+        self._probe_done = asyncio.Event()
@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+import logging
+import math
+import os
+import socket
+import zlib
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# 0 — шардирование выключено, задачи выполняет один лидер (см. leader.py)
+SCHEDULER_SHARDS = int(os.getenv("SCHEDULER_SHARDS", "0"))
+SHARD_LEASE_TTL = int(os.getenv("SHARD_LEASE_TTL", "30"))  # секунд
+SHARD_RENEW_INTERVAL = float(os.getenv("SHARD_RENEW_INTERVAL", "10"))  # секунд
+
+
+def shard_of(user_id: int, shard_count: int) -> int:
+    """Номер шарда подписчика; одинаков во всех процессах."""
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+
+class ShardLeaseManager:
+    """
+    Распределяет шарды рассылки между процессами через таблицы scheduler_workers
+    (живые воркеры, heartbeat) и scheduler_shard_leases (аренда шарда с TTL).
+    Каждый воркер держит примерно shard_count / число_воркеров шардов; аренды
+    пропавшего воркера истекают через SHARD_LEASE_TTL и достаются остальным.
+    """
+
+    def __init__(self, shard_count: int,
+                 on_change: Callable[[frozenset], Awaitable[None]],
+                 lease_ttl: int = SHARD_LEASE_TTL, renew_interval: float = SHARD_RENEW_INTERVAL):
+        self._pool = None
+        self.shard_count = shard_count
+        self._on_change = on_change
+        self._lease_ttl = lease_ttl
+        self._renew_interval = renew_interval
+        self._task: asyncio.Task | None = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.owned: frozenset = frozenset()
+        self.live_workers = 0
+
+    def owns(self, user_id: int) -> bool:
+        return shard_of(user_id, self.shard_count) in self.owned
+
+    def status(self) -> dict:
+        return {
+            "worker": self.worker_id,
+            "shard_count": self.shard_count,
+            "owned": sorted(self.owned),
+            "live_workers": self.live_workers,
+        }
+
+    def start(self, pool) -> None:
+        self._pool = pool
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="shard-leases")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute("""
+                    UPDATE scheduler_shard_leases SET owner = NULL, expires_at = now() WHERE owner = $1;
+                """, self.worker_id)
+                await conn.execute("DELETE FROM scheduler_workers WHERE worker_id = $1;", self.worker_id)
+        except Exception as e:
+            logger.error(f"Shards: can't release leases on shutdown: {e}")
+        await self._set_owned(frozenset())
+
+    async def _set_owned(self, owned: frozenset) -> None:
+        if owned == self.owned:
+            return
+        logger.warning(f"Shards: {self.worker_id} now owns {len(owned)}/{self.shard_count} shards: {sorted(owned)}")
+        self.owned = owned
+        try:
+            await self._on_change(owned)
+        except Exception as e:
+            logger.error(f"Shards: on_change callback failed: {e}", exc_info=True)
+
+    async def _run(self) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO scheduler_shard_leases (shard_id)
+                SELECT generate_series(0, $1 - 1)
+                ON CONFLICT (shard_id) DO NOTHING;
+            """, self.shard_count)
+        while True:
+            try:
+                await self._set_owned(await self._rebalance())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Shards: rebalance failed: {e}", exc_info=True)
+                # не смогли продлить аренду — не считаем шарды своими
+                await self._set_owned(frozenset())
+            await asyncio.sleep(self._renew_interval)
+
+    async def _rebalance(self) -> frozenset:
+        ttl = datetime.timedelta(seconds=self._lease_ttl)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO scheduler_workers (worker_id, heartbeat_at) VALUES ($1, now())
+                    ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = now();
+                """, self.worker_id)
+                self.live_workers = await conn.fetchval("""
+                    SELECT count(*) FROM scheduler_workers WHERE heartbeat_at > now() - $1::INTERVAL;
+                """, ttl)
+                owned = {r["shard_id"] for r in await conn.fetch("""
+                    UPDATE scheduler_shard_leases SET expires_at = now() + $2::INTERVAL
+                    WHERE owner = $1 AND shard_id < $3
+                    RETURNING shard_id;
+                """, self.worker_id, ttl, self.shard_count)}
+
+                fair_share = math.ceil(self.shard_count / max(self.live_workers, 1))
+                if len(owned) > fair_share:
+                    # появился новый воркер — отдаём лишние шарды
+                    extra = sorted(owned)[fair_share:]
+                    await conn.execute("""
+                        UPDATE scheduler_shard_leases SET owner = NULL, expires_at = now()
+                        WHERE owner = $1 AND shard_id = ANY($2::INT[]);
+                    """, self.worker_id, extra)
+                    owned -= set(extra)
+                elif len(owned) < fair_share:
+                    # забираем свободные и просроченные шарды (в том числе пропавших воркеров)
+                    claimed = await conn.fetch("""
+                        UPDATE scheduler_shard_leases SET owner = $1, expires_at = now() + $2::INTERVAL
+                        WHERE shard_id IN (
+                            SELECT shard_id FROM scheduler_shard_leases
+                            WHERE shard_id < $4 AND (owner IS NULL OR expires_at <= now())
+                            ORDER BY shard_id
+                            LIMIT $3
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING shard_id;
+                    """, self.worker_id, ttl, fair_share - len(owned), self.shard_count)
+                    owned |= {r["shard_id"] for r in claimed}
+
+                await conn.execute("""
+                    DELETE FROM scheduler_workers WHERE heartbeat_at < now() - $1::INTERVAL * 10;
+                """, ttl)
+        return frozenset(owned)
@@ -0,0 +1,134 @@
+from alerts import ALERT_FORECAST_UPDATE_INTERVAL, ALERT_MIN_RECHECK, FORECAST_STEP, AlertPlanner
+from forecast_series import ForecastSeries
+
+NOW = 1_782_000_000  # кратно FORECAST_STEP
+CLEAR, RAIN = 800, 500
+
+
+def series(points, city_id: int = 1, received_at: float = NOW) -> ForecastSeries:
+    """points: [(смещение от NOW в секундах, температура, код погоды), ...]"""
+    result = ForecastSeries.from_response({
+        "city": {"id": city_id, "name": "Город", "timezone": 0},
+        "list": [{"dt": NOW + offset, "main": {"temp": temp}, "wind": {"speed": 1},
+                  "weather": [{"id": code, "description": "погода"}], "pop": 0}
+                 for offset, temp, code in points],
+    })
+    result.received_at = received_at
+    return result
+
+
+def calm(*offsets) -> list:
+    return [(offset, -5, CLEAR) for offset in offsets]
+
+
+def test_unknown_city_is_due_and_then_waits_for_next_forecast():
+    planner = AlertPlanner()
+    assert planner.due([1], NOW) == [1]
+
+    assert planner.evaluate({1: series(calm(0, FORECAST_STEP, 2 * FORECAST_STEP))}, NOW) == []
+    assert planner.due([1], NOW + ALERT_FORECAST_UPDATE_INTERVAL - 1) == []
+    assert planner.due([1], NOW + ALERT_FORECAST_UPDATE_INTERVAL) == [1]
+
+
+def test_due_forgets_cities_without_subscribers():
+    planner = AlertPlanner()
+    planner.evaluate({1: series(calm(0)), 2: series(calm(0), city_id=2)}, NOW)
+    assert len(planner) == 2
+
+    planner.due([2], NOW)
+    assert len(planner) == 1
+
+
+def test_recheck_when_known_precipitation_enters_window():
+    planner = AlertPlanner()
+    # дождь через 3 часа, окно осадков — час: город надо проверить за час до дождя
+    planner.evaluate({1: series(calm(0) + [(FORECAST_STEP, -5, RAIN)])}, NOW)
+
+    assert planner.due([1], NOW + FORECAST_STEP - 3600 - 1) == []
+    assert planner.due([1], NOW + FORECAST_STEP - 3600) == [1]
+
+
+def test_recheck_is_not_sooner_than_min_interval():
+    planner = AlertPlanner()
+    planner.evaluate({1: series(calm(0) + [(3600 + 60, -5, RAIN)])}, NOW)
+
+    assert planner.due([1], NOW + ALERT_MIN_RECHECK - 1) == []
+    assert planner.due([1], NOW + ALERT_MIN_RECHECK) == [1]
+
+
+def test_postpone_after_failed_fetch():
+    planner = AlertPlanner()
+    planner.postpone(1, NOW)
+
+    assert planner.due([1], NOW + ALERT_MIN_RECHECK - 1) == []
+    assert planner.due([1], NOW + ALERT_MIN_RECHECK) == [1]
+
+
+def test_alert_is_reported_once_per_episode():
+    planner = AlertPlanner()
+    cold = series([(0, -5, CLEAR), (FORECAST_STEP, -12, CLEAR), (2 * FORECAST_STEP, -12, CLEAR)])
+
+    alerts = planner.evaluate({1: cold}, NOW + 60)
+    assert [(a.city, a.kind, a.time) for a in alerts] == [(1, "cold", NOW + FORECAST_STEP)]
+
+    # мороз продолжается — повторно не сообщаем
+    assert planner.evaluate({1: cold}, NOW + 3600) == []
+    assert planner.evaluate({1: cold}, NOW + FORECAST_STEP + 60) == []
+
+
+def test_new_episode_after_condition_clears():
+    planner = AlertPlanner()
+    cold = series([(FORECAST_STEP, -12, CLEAR)])
+    warm = series([(FORECAST_STEP, -5, CLEAR)])
+
+    assert len(planner.evaluate({1: cold}, NOW)) == 1
+    assert planner.evaluate({1: warm}, NOW + 600) == []
+    assert [a.kind for a in planner.evaluate({1: cold}, NOW + 1200)] == ["cold"]
+
+
+def test_separated_intervals_are_different_episodes():
+    planner = AlertPlanner()
+    # мороз в 3 ч и снова в 9 ч, а между ними — нет
+    forecast = series([(FORECAST_STEP, -12, CLEAR), (2 * FORECAST_STEP, -5, CLEAR), (3 * FORECAST_STEP, -12, CLEAR)])
+
+    assert len(planner.evaluate({1: forecast}, NOW)) == 1
+    alerts = planner.evaluate({1: forecast}, NOW + 2 * FORECAST_STEP + 60)
+    assert [(a.kind, a.time) for a in alerts] == [("cold", NOW + 3 * FORECAST_STEP)]
+
+
+def test_kinds_have_separate_episodes():
+    planner = AlertPlanner()
+    assert [a.kind for a in planner.evaluate({1: series([(3000, -12, CLEAR)])}, NOW)] == ["cold"]
+
+    alerts = planner.evaluate({1: series([(3000, -12, RAIN)])}, NOW + 300)
+    assert [a.kind for a in alerts] == ["precipitation"]
+
+
+def test_retracted_alert_is_reported_again():
+    planner = AlertPlanner()
+    cold = series([(FORECAST_STEP, -12, CLEAR)])
+    alerts = planner.evaluate({1: cold}, NOW)
+
+    planner.retract(alerts, NOW)
+    assert planner.due([1], NOW + ALERT_MIN_RECHECK) == [1]
+    assert len(planner.evaluate({1: cold}, NOW + ALERT_MIN_RECHECK)) == 1
+
+
+def test_continuous_precipitation_between_forecast_points_is_one_episode():
+    planner = AlertPlanner()
+    rain = series([(0, -5, CLEAR)] + [(step * FORECAST_STEP, -5, RAIN) for step in range(1, 5)])
+
+    assert [a.kind for a in planner.evaluate({1: rain}, NOW + FORECAST_STEP - 3600)] == ["precipitation"]
+    # между точками прогноза в часовое окно осадков ничего не попадает, но дождь продолжается
+    assert planner.evaluate({1: rain}, NOW + FORECAST_STEP + 1800) == []
+    assert planner.evaluate({1: rain}, NOW + 2 * FORECAST_STEP - 3600) == []
+
+
+def test_episode_start_does_not_move_with_time():
+    rain = series([(0, -5, CLEAR)] + [(step * FORECAST_STEP, -5, RAIN) for step in range(1, 5)])
+    first = AlertPlanner().evaluate({1: rain}, NOW + FORECAST_STEP - 3600)
+    # новый процесс (после перезапуска) в середине того же эпизода
+    restarted = AlertPlanner().evaluate({1: rain}, NOW + 2 * FORECAST_STEP - 3600)
+
+    assert [a.since for a in first] == [a.since for a in restarted] == [NOW + FORECAST_STEP]
+    assert restarted[0].time == NOW + 2 * FORECAST_STEP
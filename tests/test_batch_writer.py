@@ -0,0 +1,45 @@
+import asyncio
+
+from database import BatchWriter
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_failed_flush_keeps_rows_and_retries():
+    async def scenario():
+        written = []
+        failures = [ConnectionError("db down")]
+
+        async def flush(rows):
+            if failures:
+                raise failures.pop()
+            written.extend(rows)
+
+        writer = BatchWriter("test", flush, max_batch=100, max_delay=0.01)
+        writer.add(1)
+        writer.add(2)
+        await writer.flush()  # сбой: строки остаются в буфере
+        assert written == []
+        writer.add(3)
+        await asyncio.sleep(0.05)  # повтор по таймеру
+        assert written == [1, 2, 3]
+        await writer.close()
+
+    run(scenario())
+
+
+def test_buffer_drops_oldest_rows_over_limit():
+    async def scenario():
+        async def flush(rows):
+            raise ConnectionError("db down")
+
+        writer = BatchWriter("test", flush, max_batch=100, max_delay=10, max_buffer=3)
+        for row in range(5):
+            writer.add(row)
+        await writer.flush()
+        assert writer._buffer == [2, 3, 4]
+        await writer.close()
+
+    run(scenario())
@@ -0,0 +1,59 @@
+import datetime
+
+import pytest
+import pytz
+
+from database import compute_next_daily_fire
+
+
+def utc(*args) -> datetime.datetime:
+    return pytz.utc.localize(datetime.datetime(*args))
+
+
+def test_later_today():
+    assert compute_next_daily_fire(datetime.time(8, 0), "Europe/Moscow", utc(2026, 1, 1, 4, 0)) == utc(2026, 1, 1, 5, 0)
+
+
+def test_already_passed_moves_to_tomorrow():
+    assert compute_next_daily_fire(datetime.time(8, 0), "Europe/Moscow", utc(2026, 1, 1, 5, 0)) == utc(2026, 1, 2, 5, 0)
+
+
+def test_local_date_differs_from_utc_date():
+    # в Токио уже 2 января, 08:00 по Токио — 23:00 UTC 2 января
+    assert compute_next_daily_fire(datetime.time(8, 0), "Asia/Tokyo", utc(2026, 1, 1, 23, 30)) == utc(2026, 1, 2, 23, 0)
+
+
+def test_utc_offset_changes_with_dst():
+    # 29.03.2026 Берлин переходит с CET (+1) на CEST (+2)
+    assert compute_next_daily_fire(datetime.time(8, 0), "Europe/Berlin", utc(2026, 3, 28, 12)) == utc(2026, 3, 29, 6, 0)
+    assert compute_next_daily_fire(datetime.time(8, 0), "Europe/Berlin", utc(2026, 3, 27, 12)) == utc(2026, 3, 28, 7, 0)
+
+
+def test_nonexistent_local_time_in_dst_gap():
+    # 02:30 29.03.2026 в Берлине не существует (часы переводят с 02:00 на 03:00) — отправка в 03:30 CEST
+    fire_at = compute_next_daily_fire(datetime.time(2, 30), "Europe/Berlin", utc(2026, 3, 28, 12))
+    assert fire_at == utc(2026, 3, 29, 1, 30)
+    assert fire_at.astimezone(pytz.timezone("Europe/Berlin")).strftime("%H:%M %Z") == "03:30 CEST"
+
+
+def test_ambiguous_local_time_uses_standard_time():
+    # 02:30 25.10.2026 в Берлине бывает дважды — берётся второе (CET), отправка одна
+    fire_at = compute_next_daily_fire(datetime.time(2, 30), "Europe/Berlin", utc(2026, 10, 24, 12))
+    assert fire_at == utc(2026, 10, 25, 1, 30)
+    assert compute_next_daily_fire(datetime.time(2, 30), "Europe/Berlin", fire_at) == utc(2026, 10, 26, 1, 30)
+
+
+def test_dst_gap_in_new_york():
+    # 08.03.2026 Нью-Йорк: 02:00 EST -> 03:00 EDT
+    fire_at = compute_next_daily_fire(datetime.time(2, 15), "America/New_York", utc(2026, 3, 7, 12))
+    assert fire_at == utc(2026, 3, 8, 7, 15)
+
+
+def test_result_is_strictly_after():
+    after = utc(2026, 1, 1, 5, 0)
+    assert compute_next_daily_fire(datetime.time(8, 0), "Europe/Moscow", after) > after
+
+
+def test_unknown_timezone():
+    with pytest.raises(pytz.UnknownTimeZoneError):
+        compute_next_daily_fire(datetime.time(8, 0), "Mars/Olympus", utc(2026, 1, 1))
@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+from rate_limit import CircuitBreaker, PriorityTokenBucket
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _drained_bucket(rate: float = 50) -> PriorityTokenBucket:
+    bucket = PriorityTokenBucket(rate, capacity=1)
+    assert bucket.try_acquire()
+    return bucket
+
+
+def test_bucket_gives_burst_then_waits():
+    async def scenario():
+        bucket = PriorityTokenBucket(20, capacity=2)
+        assert bucket.try_acquire()
+        assert bucket.try_acquire()
+        assert not bucket.try_acquire()
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    assert run(scenario()) >= 0.04
+
+
+def test_waiters_are_served_by_priority_then_fifo():
+    async def scenario():
+        bucket = await _drained_bucket()
+        order = []
+
+        async def take(name, priority):
+            await bucket.acquire(priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(take(name, priority))
+                 for name, priority in [("alerts-1", 2), ("daily", 1), ("alerts-2", 2), ("interactive", 0)]]
+        await asyncio.sleep(0)
+        assert bucket.waiting == 4
+        assert not bucket.try_acquire()  # очередь не обгоняют
+        await asyncio.gather(*tasks)
+        assert bucket.waiting == 0
+        return order
+
+    assert run(scenario()) == ["interactive", "daily", "alerts-1", "alerts-2"]
+
+
+def test_raise_priority_moves_queued_waiter_ahead():
+    async def scenario():
+        bucket = await _drained_bucket()
+        order = []
+
+        async def take(name, ticket):
+            await bucket.wait(ticket)
+            order.append(name)
+
+        daily = asyncio.create_task(take("daily", bucket.enqueue(1)))
+        alerts_ticket = bucket.enqueue(2)
+        alerts = asyncio.create_task(take("alerts", alerts_ticket))
+        bucket.raise_priority(alerts_ticket, 0)
+        bucket.raise_priority(alerts_ticket, 2)  # понизить нельзя
+        await asyncio.gather(daily, alerts)
+        assert bucket.waiting == 0
+        return order
+
+    assert run(scenario()) == ["alerts", "daily"]
+
+
+def test_cancelled_waiter_does_not_consume_token():
+    async def scenario():
+        bucket = await _drained_bucket()
+        cancelled = asyncio.create_task(bucket.acquire(0))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert bucket.waiting == 0
+        await asyncio.wait_for(bucket.acquire(1), timeout=1)
+
+    run(scenario())
+
+
+def test_pause_holds_all_waiters():
+    async def scenario():
+        bucket = PriorityTokenBucket(100, capacity=5)
+        bucket.pause(0.05)
+        assert not bucket.try_acquire()
+        started = time.monotonic()
+        await bucket.acquire(0)
+        return time.monotonic() - started
+
+    assert run(scenario()) >= 0.04
+
+
+def test_breaker_opens_after_consecutive_failures():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.05)
+        for _ in range(2):
+            await breaker.wait()
+            breaker.record_failure()
+        await breaker.wait()
+        breaker.record_success()  # успех сбрасывает счётчик
+        for _ in range(2):
+            await breaker.wait()
+            breaker.record_failure()
+        assert breaker.state == "closed"
+        await breaker.wait()
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+        started = time.monotonic()
+        await breaker.wait()
+        assert time.monotonic() - started >= 0.04
+        assert breaker.state == "half_open"
+
+    run(scenario())
+
+
+def test_half_open_lets_one_probe_and_closes_on_success():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        await breaker.wait()
+        breaker.record_failure()
+        await asyncio.sleep(0.02)
+
+        await breaker.wait()  # проба
+        second = asyncio.create_task(breaker.wait())
+        await asyncio.sleep(0.01)
+        assert not second.done()  # остальные ждут итога пробы
+
+        breaker.record_success()
+        await asyncio.wait_for(second, timeout=1)
+        assert breaker.state == "closed"
+
+    run(scenario())
+
+
+def test_failed_probe_reopens():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0.01)
+        for _ in range(5):
+            await breaker.wait()
+            breaker.record_failure()
+        await asyncio.sleep(0.02)
+
+        await breaker.wait()
+        breaker.record_failure()  # одной ошибки пробы достаточно
+        assert breaker.state == "open"
+
+    run(scenario())
+
+
+def test_released_probe_passes_to_next_caller():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        await breaker.wait()
+        breaker.record_failure()
+        await asyncio.sleep(0.02)
+
+        await breaker.wait()
+        second = asyncio.create_task(breaker.wait())
+        await asyncio.sleep(0)
+        breaker.release()  # проба отменена без результата
+        await asyncio.wait_for(second, timeout=1)
+        assert breaker.state == "half_open"
+
+    run(scenario())
+
+
+def test_wait_with_timeout_fails_fast_while_open():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        await breaker.wait()
+        breaker.record_failure()
+
+        started = time.monotonic()
+        assert await breaker.wait(timeout=1) is False  # цепь разомкнута дольше — не ждём
+        assert time.monotonic() - started < 0.1
+
+    run(scenario())
+
+
+def test_wait_with_timeout_gives_up_on_running_probe():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        await breaker.wait()
+        breaker.record_failure()
+        await asyncio.sleep(0.02)
+
+        assert await breaker.wait(timeout=1) is True  # проба
+        assert await breaker.wait(timeout=0.02) is False
+        breaker.record_success()
+        assert await breaker.wait(timeout=0.02) is True
+
+    run(scenario())
@@ -0,0 +1,104 @@
+import datetime
+
+import pytz
+
+from timing_wheel import MINUTES_PER_DAY, TimingWheel, WheelEntry, slot_of
+
+
+def utc(*args) -> datetime.datetime:
+    return pytz.utc.localize(datetime.datetime(*args))
+
+
+def entry(user_id: int, fire_at: datetime.datetime, city: str = "Москва") -> WheelEntry:
+    return WheelEntry(user_id, city, datetime.time(8, 0), "Europe/Moscow", fire_at)
+
+
+def started_wheel(now: datetime.datetime) -> TimingWheel:
+    wheel = TimingWheel()
+    wheel.load([], now)
+    return wheel
+
+
+def test_slot_wraps_around_midnight():
+    assert slot_of(utc(2026, 1, 1, 0, 0)) == 0
+    assert slot_of(utc(2026, 1, 1, 23, 59)) == MINUTES_PER_DAY - 1
+    assert slot_of(utc(2026, 1, 2, 0, 0)) == slot_of(utc(2026, 1, 1, 0, 0))
+
+
+def test_drain_across_midnight():
+    wheel = started_wheel(utc(2026, 1, 1, 23, 58))
+    before = entry(1, utc(2026, 1, 1, 23, 59))
+    after = entry(2, utc(2026, 1, 2, 0, 1))
+    wheel.add(before)
+    wheel.add(after)
+
+    assert wheel.drain(utc(2026, 1, 1, 23, 59, 30)) == [before]
+    assert wheel.drain(utc(2026, 1, 2, 0, 0, 30)) == []
+    assert wheel.drain(utc(2026, 1, 2, 0, 1, 30)) == [after]
+    assert len(wheel) == 0
+
+
+def test_entry_for_tomorrow_stays_in_shared_slot():
+    wheel = started_wheel(utc(2026, 1, 1, 8, 0))
+    tomorrow = entry(1, utc(2026, 1, 2, 8, 1))
+    wheel.add(tomorrow)
+
+    # тот же слот сегодня: запись ещё не наступила и остаётся в колесе
+    assert wheel.drain(utc(2026, 1, 1, 8, 1, 30)) == []
+    assert (1, "Москва") in wheel
+    assert wheel.drain(utc(2026, 1, 2, 8, 1, 30)) == [tomorrow]
+
+
+def test_late_tick_catches_up_missed_minutes():
+    wheel = started_wheel(utc(2026, 1, 1, 7, 59))
+    entries = [entry(i, utc(2026, 1, 1, 8, i)) for i in range(5)]
+    for e in entries:
+        wheel.add(e)
+
+    # тик опоздал на несколько минут — разбираются все пропущенные слоты
+    due = wheel.drain(utc(2026, 1, 1, 8, 3, 30))
+    assert sorted(e.user_id for e in due) == [0, 1, 2, 3]
+    assert wheel.drain(utc(2026, 1, 1, 8, 3, 30)) == []
+    assert [e.user_id for e in wheel.drain(utc(2026, 1, 1, 8, 4, 30))] == [4]
+
+
+def test_entry_in_the_past_goes_to_next_tick():
+    wheel = started_wheel(utc(2026, 1, 1, 8, 0))
+    wheel.drain(utc(2026, 1, 1, 8, 10))
+    overdue = entry(1, utc(2026, 1, 1, 8, 5))
+    wheel.add(overdue)
+
+    assert wheel.drain(utc(2026, 1, 1, 8, 11)) == [overdue]
+
+
+def test_peek_does_not_remove_and_respects_bounds():
+    wheel = started_wheel(utc(2026, 1, 1, 23, 50))
+    inside = [entry(1, utc(2026, 1, 1, 23, 58)), entry(2, utc(2026, 1, 2, 0, 2))]
+    outside = [entry(3, utc(2026, 1, 1, 23, 55)), entry(4, utc(2026, 1, 2, 0, 5)),
+               entry(5, utc(2026, 1, 2, 23, 59))]
+    for e in inside + outside:
+        wheel.add(e)
+
+    found = wheel.peek(utc(2026, 1, 1, 23, 56), utc(2026, 1, 2, 0, 5))
+    assert sorted(e.user_id for e in found) == [1, 2]
+    assert len(wheel) == 5
+
+
+def test_add_moves_existing_subscription():
+    wheel = started_wheel(utc(2026, 1, 1, 7, 0))
+    wheel.add(entry(1, utc(2026, 1, 1, 8, 0)))
+    moved = entry(1, utc(2026, 1, 1, 9, 0))
+    wheel.add(moved)
+
+    assert len(wheel) == 1
+    assert wheel.drain(utc(2026, 1, 1, 8, 30)) == []
+    assert wheel.drain(utc(2026, 1, 1, 9, 0)) == [moved]
+
+
+def test_filter_rejects_foreign_subscriptions():
+    wheel = started_wheel(utc(2026, 1, 1, 7, 0))
+    wheel.set_filter(lambda key: key[0] % 2 == 0)
+    wheel.add(entry(1, utc(2026, 1, 1, 8, 0)))
+    wheel.add(entry(2, utc(2026, 1, 1, 8, 0)))
+
+    assert [e.user_id for e in wheel.drain(utc(2026, 1, 1, 8, 0))] == [2]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+import weather_api
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    weather_api._response_cache.clear()
+    weather_api._inflight.clear()
+    yield
+    weather_api._response_cache.clear()
+    weather_api._inflight.clear()
+
+
+def slow_fetch(calls: list, payload):
+    async def fetch(endpoint, params, cache_keys=()):
+        calls.append(endpoint)
+        await asyncio.sleep(0.05)
+        return payload
+    return fetch
+
+
+def test_cancelled_owner_does_not_cancel_joined_waiter(monkeypatch):
+    calls = []
+    monkeypatch.setattr(weather_api, "_fetch_json", slow_fetch(calls, {"cod": 200, "id": 1, "dt": 1}))
+
+    async def scenario():
+        owner = asyncio.create_task(weather_api._cached_fetch("weather", {"id": 1}))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(weather_api._cached_fetch("weather", {"id": 1}))
+        await asyncio.sleep(0)
+        owner.cancel()
+
+        assert (await waiter)["id"] == 1
+        assert owner.cancelled()
+        assert calls == ["weather"]
+
+    run(scenario())
+
+
+def test_cancelled_group_caller_does_not_cancel_single_waiter(monkeypatch):
+    calls = []
+    monkeypatch.setattr(weather_api, "_fetch_json",
+                        slow_fetch(calls, {"list": [{"id": 1, "dt": 1}, {"id": 2, "dt": 1}]}))
+
+    async def scenario():
+        batch = asyncio.create_task(weather_api.get_weather_batch([1, 2]))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(weather_api._cached_fetch("weather", {"id": 2}))
+        await asyncio.sleep(0)
+        batch.cancel()
+
+        assert (await waiter)["id"] == 2
+        assert calls == ["group"]
+
+    run(scenario())
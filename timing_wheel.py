@@ -0,0 +1,173 @@
+import asyncio
+import datetime
+import logging
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 1440
+
+
+class WheelEntry:
+    """Подписка на утренний прогноз, разложенная по минутному слоту (UTC)."""
+    __slots__ = ("user_id", "city", "notification_time", "timezone", "fire_at", "city_id")
+
+    def __init__(self, user_id: int, city: str, notification_time: datetime.time,
+                 timezone: str, fire_at: datetime.datetime, city_id: int | None = None):
+        self.user_id = user_id
+        self.city = city
+        self.notification_time = notification_time
+        self.timezone = timezone or "UTC"
+        self.fire_at = fire_at
+        self.city_id = city_id
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row["user_id"], row["city"], row["notification_time"],
+                   row["timezone"], row["next_daily_fire_at"], row["city_id"])
+
+    @property
+    def key(self) -> tuple:
+        return self.user_id, self.city
+
+    def same_schedule(self, other: "WheelEntry") -> bool:
+        return (self.notification_time == other.notification_time
+                and self.timezone == other.timezone
+                and self.fire_at == other.fire_at
+                and self.city_id == other.city_id)
+
+
+def _minute_floor(dt: datetime.datetime) -> datetime.datetime:
+    return dt.replace(second=0, microsecond=0)
+
+
+def slot_of(dt: datetime.datetime) -> int:
+    dt = dt.astimezone(pytz.utc)
+    return dt.hour * 60 + dt.minute
+
+
+class TimingWheel:
+    """
+    Колесо из 1440 минутных слотов (сутки UTC). Каждая подписка лежит в слоте
+    своего next_daily_fire_at, поэтому тик разбирает только текущий слот — O(due).
+    """
+
+    def __init__(self):
+        self._slots: list[dict[tuple, WheelEntry]] = [{} for _ in range(MINUTES_PER_DAY)]
+        self._slot_by_key: dict[tuple, int] = {}
+        # Последняя разобранная минута; всё, что «в прошлом» относительно неё, кладём в следующий слот
+        self._cursor: datetime.datetime | None = None
+        # Тик и сверка с БД не должны перекрываться
+        self.lock = asyncio.Lock()
+        # Какие подписки держит этот процесс (при шардировании — только свои шарды)
+        self._accepts = lambda key: True
+
+    def set_filter(self, accepts) -> None:
+        """accepts(key) -> bool; записи, не прошедшие фильтр, в колесо не попадают."""
+        self._accepts = accepts
+
+    def __len__(self) -> int:
+        return len(self._slot_by_key)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._slot_by_key
+
+    def get(self, key: tuple) -> WheelEntry | None:
+        slot = self._slot_by_key.get(key)
+        return self._slots[slot].get(key) if slot is not None else None
+
+    def add(self, entry: WheelEntry) -> None:
+        """Добавляет или переносит подписку. Просроченные записи попадают в ближайший тик."""
+        if entry.fire_at is None:
+            return
+        self.remove(*entry.key)
+        if not self._accepts(entry.key):
+            return
+        if self._cursor is not None and entry.fire_at < self._cursor + datetime.timedelta(minutes=1):
+            slot = slot_of(self._cursor + datetime.timedelta(minutes=1))
+        else:
+            slot = slot_of(entry.fire_at)
+        self._slots[slot][entry.key] = entry
+        self._slot_by_key[entry.key] = slot
+
+    def add_row(self, row) -> None:
+        self.add(WheelEntry.from_row(row))
+
+    def remove(self, user_id: int, city: str) -> WheelEntry | None:
+        key = (user_id, city)
+        slot = self._slot_by_key.pop(key, None)
+        if slot is None:
+            return None
+        return self._slots[slot].pop(key, None)
+
+    def load(self, rows, now_utc: datetime.datetime) -> None:
+        """Полная загрузка из БД (при старте)."""
+        self._slots = [{} for _ in range(MINUTES_PER_DAY)]
+        self._slot_by_key = {}
+        self._cursor = _minute_floor(now_utc) - datetime.timedelta(minutes=1)
+        for row in rows:
+            self.add_row(row)
+        logger.info(f"TimingWheel: loaded {len(self)} subscriptions")
+
+    def drain(self, until_utc: datetime.datetime) -> list[WheelEntry]:
+        """
+        Забирает из колеса подписки с fire_at <= until_utc. Разбираются слоты от курсора
+        до минуты until_utc (если тик опоздал — догоняем пропущенные минуты).
+        """
+        target = _minute_floor(until_utc)
+        if self._cursor is None:
+            self._cursor = target - datetime.timedelta(minutes=1)
+        minutes = int((target - self._cursor).total_seconds() // 60)
+        if minutes <= 0:
+            return []
+
+        due = []
+        for step in range(1, min(minutes, MINUTES_PER_DAY) + 1):
+            slot = self._slots[slot_of(self._cursor + datetime.timedelta(minutes=step))]
+            for key, entry in list(slot.items()):
+                if entry.fire_at <= until_utc:
+                    del slot[key]
+                    del self._slot_by_key[key]
+                    due.append(entry)
+        self._cursor = target
+        return due
+
+    def peek(self, start_utc: datetime.datetime, end_utc: datetime.datetime) -> list[WheelEntry]:
+        """Подписки с fire_at в [start_utc, end_utc), не изымая их из колеса."""
+        result = []
+        minute = _minute_floor(start_utc)
+        for _ in range(MINUTES_PER_DAY):
+            if minute >= end_utc:
+                break
+            for entry in self._slots[slot_of(minute)].values():
+                if start_utc <= entry.fire_at < end_utc:
+                    result.append(entry)
+            minute += datetime.timedelta(minutes=1)
+        return result
+
+    def entries_for_timezones(self, timezones) -> list[WheelEntry]:
+        timezones = set(timezones)
+        return [entry for slot in self._slots for entry in slot.values() if entry.timezone in timezones]
+
+    def reconcile(self, rows) -> int:
+        """Приводит колесо к состоянию БД. Возвращает число исправленных расхождений."""
+        fresh = {}
+        for row in rows:
+            if row["next_daily_fire_at"] is None:
+                continue
+            entry = WheelEntry.from_row(row)
+            if self._accepts(entry.key):
+                fresh[entry.key] = entry
+
+        drift = 0
+        for key in list(self._slot_by_key):
+            if key not in fresh:
+                self.remove(*key)
+                drift += 1
+        for key, entry in fresh.items():
+            current = self.get(key)
+            if current is None or not current.same_schedule(entry):
+                self.add(entry)
+                drift += 1
+        return drift
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))  # на одного воркера
+UPDATE_DEDUPE_SIZE = int(os.getenv("UPDATE_DEDUPE_SIZE", "10000"))
+
+
+def update_chat_key(update: Update) -> int:
+    """Ключ упорядочивания: id чата, иначе id пользователя, иначе сам update_id."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else update.update_id
+
+
+class UpdateQueue:
+    """
+    Очередь входящих апдейтов Telegram. Вебхук только кладёт апдейт сюда и сразу отвечает 200.
+    Апдейты одного чата всегда попадают к одному воркеру, поэтому обрабатываются строго по порядку;
+    разные чаты обрабатываются параллельно.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = UPDATE_WORKERS,
+                 max_queue: int = UPDATE_QUEUE_MAX, dedupe_size: int = UPDATE_DEDUPE_SIZE):
+        self._dp = dp
+        self._bot = bot
+        self._queues: list[asyncio.Queue[Update]] = [asyncio.Queue(maxsize=max_queue) for _ in range(workers)]
+        self._workers: list[asyncio.Task] = []
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._dedupe_size = dedupe_size
+        self.duplicates = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker(q), name=f"updates-{i}")
+                         for i, q in enumerate(self._queues)]
+        logger.info(f"UpdateQueue: started {len(self._workers)} workers")
+
+    async def stop(self, drain_timeout: float = 10) -> None:
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"UpdateQueue: {self.queue_depth} updates left unprocessed on shutdown")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, update: Update) -> bool:
+        """
+        Ставит апдейт в очередь. Повторы (Telegram переотправил тот же update_id) отбрасываются.
+        Возвращает False, если очередь переполнена — тогда Telegram должен прислать апдейт ещё раз.
+        """
+        if update.update_id in self._seen:
+            self.duplicates += 1
+            logger.info(f"UpdateQueue: duplicate update {update.update_id} skipped")
+            return True
+        queue = self._queues[hash(update_chat_key(update)) % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning(f"UpdateQueue: queue is full, rejecting update {update.update_id}")
+            return False
+        self._seen[update.update_id] = None
+        if len(self._seen) > self._dedupe_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            update = await queue.get()
+            try:
+                await self._dp.feed_update(bot=self._bot, update=update)
+            except Exception:
+                logger.exception(f"UpdateQueue: error while processing update {update.update_id}")
+            finally:
+                queue.task_done()
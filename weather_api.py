@@ -1,137 +1,557 @@
-import requests
+import asyncio
+import contextvars
+import functools
 import os
 from dotenv import load_dotenv
 import datetime
+import logging
+import time
+from collections import OrderedDict
+import aiohttp
 import pytz
 
+from forecast_series import ForecastSeries
+from message_cache import MessageCache
+from metrics import UPSTREAM_SECONDS, cache_hit, cache_stale
+from rate_limit import CircuitBreaker, PriorityTokenBucket
+
 
 load_dotenv()
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 
+logger = logging.getLogger(__name__)
+
+OPENWEATHER_BASE_URL = "https://api.openweathermap.org/data/2.5"
+
+# Настройки HTTP-клиента (можно переопределить через .env)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("OPENWEATHER_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("OPENWEATHER_READ_TIMEOUT", "10"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("OPENWEATHER_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("OPENWEATHER_KEEPALIVE_TIMEOUT", "30"))
+
+# Кэш ответов OpenWeather (TTL + LRU)
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600"))  # секунд
+WEATHER_CACHE_MAX_ENTRIES = int(os.getenv("WEATHER_CACHE_MAX_ENTRIES", "2048"))
+# Ответ старше TTL, но моложе WEATHER_STALE_MAX отдаётся сразу (с пометкой возраста),
+# а обновляется в фоне — задержки и сбои OpenWeather не доходят до пользователя
+WEATHER_STALE_MAX = float(os.getenv("WEATHER_STALE_MAX", "3600"))  # секунд
+
+# Квота запросов к OpenWeather (по тарифу) и размыкатель при 429/5xx
+OPENWEATHER_CALLS_PER_MINUTE = float(os.getenv("OPENWEATHER_CALLS_PER_MINUTE", "60"))
+OPENWEATHER_BURST = float(os.getenv("OPENWEATHER_BURST", "5"))
+OPENWEATHER_BREAKER_FAILURES = int(os.getenv("OPENWEATHER_BREAKER_FAILURES", "5"))
+OPENWEATHER_BREAKER_RESET = float(os.getenv("OPENWEATHER_BREAKER_RESET", "30"))  # секунд
+# Сколько запрос из хендлера бота готов ждать размыкатель; фоновые запросы ждут, пока цепь не замкнётся
+OPENWEATHER_BREAKER_INTERACTIVE_WAIT = float(os.getenv("OPENWEATHER_BREAKER_INTERACTIVE_WAIT", "2"))  # секунд
+
+# Приоритеты запросов при нехватке квоты: меньше — важнее
+PRIORITY_INTERACTIVE = 0  # хендлеры бота
+PRIORITY_DAILY = 1        # утренняя рассылка
+PRIORITY_ALERTS = 2       # предупреждения (осадки и пр.)
+
+_quota = PriorityTokenBucket(OPENWEATHER_CALLS_PER_MINUTE / 60, OPENWEATHER_BURST)
+_breaker = CircuitBreaker(OPENWEATHER_BREAKER_FAILURES, OPENWEATHER_BREAKER_RESET)
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("openweather_priority", default=PRIORITY_INTERACTIVE)
+
+
+class WeatherServiceUnavailable(aiohttp.ClientError):
+    """Размыкатель открыт, и запрос из хендлера не стал ждать его замыкания."""
+
+
+def weather_priority(priority: int):
+    """Декоратор корутины: её запросы к OpenWeather идут с приоритетом priority."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = _priority.set(priority)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _priority.reset(token)
+        return wrapper
+    return decorator
+
+
+def quota_status() -> dict:
+    return {"breaker": _breaker.state, "waiting": _quota.waiting}
+
+
+# Общая сессия aiohttp: создаётся в on_startup_combined, закрывается в on_shutdown
+_session: aiohttp.ClientSession | None = None
+
+
+async def init_http_session() -> aiohttp.ClientSession:
+    """Создаёт общий HTTP-клиент с пулом keep-alive соединений к OpenWeather."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.info("OpenWeather HTTP session created.")
+    return _session
+
+
+async def close_http_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("OpenWeather HTTP session closed.")
+    _session = None
+
+
+async def _fetch_json(endpoint: str, params: dict, cache_keys=()) -> dict:
+    """
+    GET-запрос к OpenWeather через общую сессию. Возвращает JSON-ответ (в том числе с ошибкой API).
+    Пока размыкатель открыт, фоновый запрос ждёт, а интерактивный — не дольше
+    OPENWEATHER_BREAKER_INTERACTIVE_WAIT, после чего падает с WeatherServiceUnavailable.
+    Затем запрос ждёт токен квоты в очереди своего приоритета.
+    cache_keys — записи кэша, за которые отвечает запрос: присоединившиеся к ним ожидающие
+    могут поднять его приоритет, пока токен не выдан.
+    """
+    priority = _priority.get()
+    timeout = OPENWEATHER_BREAKER_INTERACTIVE_WAIT if priority == PRIORITY_INTERACTIVE else None
+    if not await _breaker.wait(timeout):
+        raise WeatherServiceUnavailable(f"OpenWeather circuit breaker is open, {endpoint} not requested")
+    ticket = _quota.enqueue(priority)
+    for key in cache_keys:
+        _queued[key] = ticket
+    try:
+        await _quota.wait(ticket)
+    except BaseException:
+        _breaker.release()
+        raise
+    finally:
+        for key in cache_keys:
+            if _queued.get(key) is ticket:
+                del _queued[key]
+    session = _session if _session is not None and not _session.closed else await init_http_session()
+    query = {**params, "appid": WEATHER_API_KEY}
+    started = time.perf_counter()
+    status = "error"
+    try:
+        async with session.get(f"{OPENWEATHER_BASE_URL}/{endpoint}", params=query) as response:
+            status = str(response.status)
+            if response.status == 429:
+                # превысили квоту тарифа — притормаживаем все запросы
+                _quota.pause(_retry_after(response.headers.get("Retry-After")))
+            try:
+                data = await response.json(content_type=None)
+            except ValueError as e:
+                # например, HTML-страница вместо JSON у 502 — для вызывающих это такой же сбой, как обрыв связи
+                raise aiohttp.ContentTypeError(response.request_info, response.history, status=response.status,
+                                               message=f"invalid JSON from {endpoint}: {e}") from e
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if isinstance(e, asyncio.TimeoutError):
+            status = "timeout"
+        _breaker.record_failure()
+        raise
+    except BaseException:
+        if _is_upstream_failure(status):
+            _breaker.record_failure()
+        else:
+            _breaker.release()
+        raise
+    finally:
+        UPSTREAM_SECONDS.labels(endpoint, status).observe(time.perf_counter() - started)
+    if _is_upstream_failure(status):
+        _breaker.record_failure()
+    else:
+        _breaker.record_success()
+    return data
+
+
+def _is_upstream_failure(status: str) -> bool:
+    return status == "429" or status.startswith("5")
+
+
+def _retry_after(header: str | None) -> float:
+    try:
+        return float(header)
+    except (TypeError, ValueError):
+        return OPENWEATHER_BREAKER_RESET
+
+
+# ключ -> (время сохранения по time.monotonic(), JSON-ответ или ForecastSeries)
+_response_cache: "OrderedDict[tuple, tuple[float, object]]" = OrderedDict()
+# ключ -> Future запроса, который уже выполняется (single-flight)
+_inflight: dict[tuple, asyncio.Future] = {}
+# ключ -> место этого запроса в очереди квоты, пока он ждёт токен
+_queued: dict[tuple, asyncio.Future] = {}
+# Запросы к OpenWeather, идущие отдельными задачами (держим ссылки, чтобы задачи не собрал GC)
+_background: set[asyncio.Task] = set()
+# Готовые тексты сообщений; тексты города сбрасываются, когда обновляются его данные в _response_cache
+rendered_messages = MessageCache()
+
+
+def normalize_city(city: str) -> str:
+    """Каноническая форма названия города для ключей кэша и группировки."""
+    return " ".join(city.split()).casefold()
+
+
+def _location_query(city: str, city_id: int | None = None) -> dict:
+    # По id все написания города попадают в одну запись кэша и один запрос
+    return {"id": city_id} if city_id is not None else {"q": city}
+
+
+def _cache_key(endpoint: str, location: dict, units: str, lang: str) -> tuple:
+    if "id" in location:
+        return endpoint, f"id:{location['id']}", units, lang
+    return endpoint, normalize_city(location["q"]), units, lang
+
+
+# Успешные ответы этих эндпоинтов хранятся в кэше в разобранном виде
+_PARSERS = {
+    "forecast": ForecastSeries.from_response,
+}
+
+
+def data_key(endpoint: str, city: str, city_id: int | None = None) -> tuple:
+    """Ключ данных города для rendered_messages (совпадает с записью кэша ответов)."""
+    return _cache_key(endpoint, _location_query(city, city_id), "metric", "ru")[:2]
+
+
+def _cache_get(key: tuple) -> tuple[object | None, bool]:
+    """(данные, свежие ли они). Записи старше WEATHER_STALE_MAX удаляются."""
+    entry = _response_cache.get(key)
+    if entry is None:
+        cache_hit(key[0], False)
+        return None, False
+    stored_at, data = entry
+    age = time.monotonic() - stored_at
+    if age > max(WEATHER_STALE_MAX, WEATHER_CACHE_TTL):
+        del _response_cache[key]
+        cache_hit(key[0], False)
+        return None, False
+    _response_cache.move_to_end(key)
+    if age > WEATHER_CACHE_TTL:
+        cache_stale(key[0])
+        return data, False
+    cache_hit(key[0], True)
+    return data, True
+
+
+def _cache_put(key: tuple, data) -> None:
+    rendered_messages.invalidate(key[:2])
+    if isinstance(data, dict):
+        data.setdefault("_received_at", time.time())
+    _response_cache[key] = (time.monotonic(), data)
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > WEATHER_CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
+
+def data_age(data) -> float:
+    """Сколько секунд назад данные получены от OpenWeather."""
+    received_at = data.received_at if isinstance(data, ForecastSeries) else data.get("_received_at")
+    return max(time.time() - received_at, 0.0) if received_at else 0.0
+
+
+def age_label(data) -> str:
+    """Пометка для устаревших данных (пустая строка, если данные свежие)."""
+    age = data_age(data)
+    if age <= WEATHER_CACHE_TTL:
+        return ""
+    minutes = int(age // 60)
+    age_text = f"{minutes // 60} ч {minutes % 60} мин" if minutes >= 60 else f"{minutes} мин"
+    return f"⏳ Данные получены {age_text} назад, обновляем."
+
+
+def _spawn(coro, what: str) -> None:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+
+    def done(task: asyncio.Task) -> None:
+        _background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"OpenWeather request for {what} failed: {task.exception()}")
+
+    task.add_done_callback(done)
+
+
+async def _cached_fetch(endpoint: str, location: dict, units: str = "metric", lang: str = "ru"):
+    """
+    Запрос к OpenWeather через кэш (location — {"id": ...} или {"q": ...}). Одновременные
+    промахи по одному ключу ждут один общий запрос. В кэш попадают только успешные ответы;
+    для эндпоинтов из _PARSERS возвращается разобранный объект, при ошибке API — JSON как есть.
+    Устаревший ответ (моложе WEATHER_STALE_MAX) возвращается сразу, а обновляется в фоне.
+    """
+    key = _cache_key(endpoint, location, units, lang)
+    data, fresh = _cache_get(key)
+    if data is not None:
+        if not fresh and key not in _inflight:
+            future = asyncio.get_running_loop().create_future()
+            _inflight[key] = future
+            _spawn(_fetch_into_cache(key, future, endpoint, location, units, lang), f"{endpoint} {key[1]}")
+        return data
+
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        if _priority.get() == PRIORITY_INTERACTIVE and _breaker.state == "open":
+            # общий запрос фоновой рассылки ждёт замыкания цепи — хендлер ждать его не будет
+            raise WeatherServiceUnavailable(f"OpenWeather circuit breaker is open, {endpoint} not requested")
+        ticket = _queued.get(key)
+        if ticket is not None:
+            # общий запрос ещё ждёт токен (например, в очереди предупреждений) — ждём его с нашим приоритетом
+            _quota.raise_priority(ticket, _priority.get())
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(inflight)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    # запрос идёт отдельной задачей: если инициатора отменят, присоединившиеся всё равно получат ответ
+    _spawn(_fetch_into_cache(key, future, endpoint, location, units, lang), f"{endpoint} {key[1]}")
+    return await asyncio.shield(future)
+
+
+async def _fetch_into_cache(key: tuple, future: asyncio.Future, endpoint: str, location: dict,
+                            units: str, lang: str):
+    """Запрос к OpenWeather для записи кэша key; результат получают ожидающие future."""
+    try:
+        data = await _fetch_json(endpoint, {**location, "units": units, "lang": lang}, (key,))
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            # задачу отменили целиком (остановка процесса) — ожидающим отвечать уже некому
+            future.cancel()
+        else:
+            future.set_exception(e)
+            future.exception()  # помечаем исключение как полученное, если ожидающих нет
+        raise
+    else:
+        if str(data.get("cod")) == "200":
+            parser = _PARSERS.get(endpoint)
+            if parser is not None:
+                data = parser(data)
+            _cache_put(key, data)
+            city_id = data.city_id if isinstance(data, ForecastSeries) else data.get("id")
+            if "q" in location and city_id:
+                # ответ по названию годится и для запросов по id
+                _cache_put(_cache_key(endpoint, {"id": city_id}, units, lang), data)
+        future.set_result(data)
+    finally:
+        _inflight.pop(key, None)
+
+
+OPENWEATHER_GROUP_CHUNK = 20  # максимум id в одном запросе /group
+
+
+async def _fetch_group(city_ids: list[int], units: str, lang: str) -> dict[int, dict]:
+    """Один запрос /group на пачку id. Параллельные одиночные запросы по этим id ждут его результата."""
+    return await asyncio.shield(_start_group_fetch(city_ids, units, lang))
+
+
+def _start_group_fetch(city_ids: list[int], units: str, lang: str) -> asyncio.Future:
+    """
+    Запускает запрос /group отдельной задачей (отмена вызывающего его не затрагивает)
+    и возвращает future с {city_id: ответ}.
+    """
+    futures = {}
+    loop = asyncio.get_running_loop()
+    keys = [_cache_key("weather", {"id": city_id}, units, lang) for city_id in city_ids]
+    for city_id, key in zip(city_ids, keys):
+        future = loop.create_future()
+        _inflight[key] = future
+        futures[city_id] = future
+    done = loop.create_future()
+    _spawn(_fetch_group_into_cache(city_ids, keys, futures, done, units, lang), f"group {city_ids}")
+    return done
+
+
+async def _fetch_group_into_cache(city_ids: list[int], keys: list[tuple], futures: dict[int, asyncio.Future],
+                                  done: asyncio.Future, units: str, lang: str) -> None:
+    """Запрос /group для _start_group_fetch: ответы по id — в futures, весь результат — в done."""
+    try:
+        data = await _fetch_json("group", {"id": ",".join(map(str, city_ids)), "units": units, "lang": lang}, keys)
+        results = {}
+        for item in data.get("list", []):
+            item.setdefault("cod", 200)  # элементы /group не содержат cod, в отличие от /weather
+            results[item["id"]] = item
+            _cache_put(_cache_key("weather", {"id": item["id"]}, units, lang), item)
+        for city_id, future in futures.items():
+            future.set_result(results.get(city_id, {"cod": "404", "message": "city not found"}))
+        done.set_result(results)
+    except BaseException as e:
+        for future in (*futures.values(), done):
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+        raise
+    finally:
+        for key in keys:
+            _inflight.pop(key, None)
+
+
+async def get_weather_batch(city_ids, units: str = "metric", lang: str = "ru") -> dict[int, dict]:
+    """
+    Текущая погода для набора городов по id: из кэша (в том числе устаревшая, см. WEATHER_STALE_MAX),
+    остальное — запросами /group по OPENWEATHER_GROUP_CHUNK id. Возвращает {city_id: ответ};
+    города, по которым данных получить не удалось, в результат не попадают.
+    """
+    results: dict[int, dict] = {}
+    waiting: dict[int, asyncio.Future] = {}
+    missing: list[int] = []
+    stale: list[int] = []
+    for city_id in set(city_ids):
+        key = _cache_key("weather", {"id": city_id}, units, lang)
+        data, fresh = _cache_get(key)
+        if data is not None:
+            results[city_id] = data
+            if not fresh and key not in _inflight:
+                stale.append(city_id)
+        elif key in _inflight:
+            waiting[city_id] = _inflight[key]
+        else:
+            missing.append(city_id)
+
+    # устаревшие отдаём как есть, а обновляем в фоне
+    for i in range(0, len(stale), OPENWEATHER_GROUP_CHUNK):
+        chunk = stale[i:i + OPENWEATHER_GROUP_CHUNK]
+        _start_group_fetch(chunk, units, lang)
+
+    chunks = [missing[i:i + OPENWEATHER_GROUP_CHUNK] for i in range(0, len(missing), OPENWEATHER_GROUP_CHUNK)]
+    for chunk, chunk_result in zip(chunks, await asyncio.gather(
+            *(_fetch_group(chunk, units, lang) for chunk in chunks), return_exceptions=True)):
+        if isinstance(chunk_result, BaseException):
+            logger.error(f"get_weather_batch: group request failed for {chunk}: {chunk_result}")
+            continue
+        results.update(chunk_result)
+
+    for city_id, future in waiting.items():
+        try:
+            data = await asyncio.shield(future)
+        except Exception as e:
+            logger.error(f"get_weather_batch: request failed for city {city_id}: {e}")
+            continue
+        if str(data.get("cod")) == "200":
+            results[city_id] = data
+    return results
+
+
+async def prefetch_weather(city_ids, fresh_for: float, max_calls: int,
+                           units: str = "metric", lang: str = "ru") -> int:
+    """
+    Заранее загружает в кэш текущую погоду городов, для которых данных нет или они
+    устареют раньше, чем через fresh_for секунд. Не больше max_calls запросов /group.
+    Возвращает число обновлённых городов.
+    """
+    now = time.monotonic()
+    needed = []
+    for city_id in set(city_ids):
+        key = _cache_key("weather", {"id": city_id}, units, lang)
+        if key in _inflight:
+            continue
+        entry = _response_cache.get(key)
+        if entry is None or now - entry[0] > WEATHER_CACHE_TTL - fresh_for:
+            needed.append(city_id)
+
+    chunks = [needed[i:i + OPENWEATHER_GROUP_CHUNK] for i in range(0, len(needed), OPENWEATHER_GROUP_CHUNK)]
+    if len(chunks) > max_calls:
+        logger.warning(f"prefetch_weather: budget of {max_calls} calls covers "
+                       f"{max_calls * OPENWEATHER_GROUP_CHUNK} of {len(needed)} cities")
+        chunks = chunks[:max_calls]
+    fetched = 0
+    for chunk, chunk_result in zip(chunks, await asyncio.gather(
+            *(_fetch_group(chunk, units, lang) for chunk in chunks), return_exceptions=True)):
+        if isinstance(chunk_result, BaseException):
+            logger.error(f"prefetch_weather: group request failed for {chunk}: {chunk_result}")
+            continue
+        fetched += len(chunk_result)
+    return fetched
+
+
 def format_weather_response(data, city):
     weather_desc = data["weather"][0]["description"].capitalize()
     temp = data["main"]["temp"]
     humidity = data["main"]["humidity"]
     wind_speed = data["wind"]["speed"]
 
-    return (f"🌍 Погода в {city}:\n"
+    text = (f"🌍 Погода в {city}:\n"
             f"🌡 Температура: {temp}°C\n"
             f"💨 Ветер: {wind_speed} м/с\n"
             f"💧 Влажность: {humidity}%\n"
             f"☁ {weather_desc}")
+    label = age_label(data)
+    return f"{text}\n{label}" if label else text
+
+def render_weather_response(data, city, city_id: int | None = None) -> str:
+    """format_weather_response через кэш текстов: один текст на город, написание и пометку возраста."""
+    return rendered_messages.render(data_key("weather", city, city_id), data.get("dt"), "weather",
+                                    (city, age_label(data)), lambda: format_weather_response(data, city))
 
-async def get_weather(city):
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric&lang=ru"
-    response = requests.get(url)
-    data = response.json()
+
+async def geocode_city(name: str) -> dict | None:
+    """
+    Находит город в OpenWeather по названию: id, каноническое имя, координаты, UTC-смещение.
+    Ответ кэшируется вместе с текущей погодой. None — город не найден.
+    """
+    data = await _cached_fetch("weather", _location_query(name))
+    if str(data.get("cod")) != "200":
+        return None
+    return {
+        "id": data["id"],
+        "name": data.get("name") or name,
+        "country": data.get("sys", {}).get("country"),
+        "lat": data["coord"]["lat"],
+        "lon": data["coord"]["lon"],
+        "utc_offset": data.get("timezone"),
+    }
+
+
+async def get_weather(city, city_id: int | None = None):
+    try:
+        data = await _cached_fetch("weather", _location_query(city, city_id))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"get_weather: request failed for {city}: {e}")
+        return "Ошибка: сервис погоды недоступен"
 
     if data.get("cod") != 200:
         return f"Ошибка: {data.get('message', 'Город не найден')}"
 
-    return format_weather_response(data, city)
+    return render_weather_response(data, city, city_id)
 
-async def get_forecast(city):
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang=ru"
-    response = requests.get(url)
-    data = response.json()
+async def get_forecast(city, city_id: int | None = None):
+    try:
+        series = await _cached_fetch("forecast", _location_query(city, city_id))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"get_forecast: request failed for {city}: {e}")
+        return "Ошибка: сервис погоды недоступен"
 
-    if data.get("cod") != "200":
-        return f"Ошибка: {data.get('message', 'Город не найден')}"
+    if not isinstance(series, ForecastSeries):
+        return f"Ошибка: {series.get('message', 'Город не найден')}"
 
     forecast_text = f"📅 Прогноз погоды для {city} (3 дня):\n"
     count = 0
-    for item in data["list"]:
-        dt_txt = item["dt_txt"]
-        if "12:00:00" in dt_txt:
-            desc = item["weather"][0]["description"].capitalize()
-            temp = item["main"]["temp"]
-            forecast_text += f"\n📆 {dt_txt[:10]}: {temp}°C, {desc}"
+    for i, ts in enumerate(series.times):
+        forecast_utc_time = datetime.datetime.fromtimestamp(ts, pytz.utc)
+        if forecast_utc_time.hour == 12:
+            desc = series.description(i).capitalize()
+            temp = round(series.temps[i], 2)
+            forecast_text += f"\n📆 {forecast_utc_time:%Y-%m-%d}: {temp}°C, {desc}"
             count += 1
         if count == 3:
             break
 
-    return forecast_text
-
-def detect_weather_alerts(data):
-    alerts = []
-    temp = data["main"]["temp"]
-    wind = data["wind"]["speed"]
-
-    if temp < -10:
-        alerts.append("🧊 Очень холодно!")
-    elif temp > 30:
-        alerts.append("🔥 Жара!")
-
-    if wind > 10:
-        alerts.append("🌪 Сильный ветер!")
-
-    return alerts
-
-PRECIPITATION_CODES = {
-    # Drizzle
-    300, 301, 302, 310, 311, 312, 313, 314, 321,
-    # Rain
-    500, 501, 502, 503, 504, 511, 520, 521, 522, 531,
-    # Snow
-    600, 601, 602, 611, 612, 613, 615, 616, 620, 621, 622,
-    # Thunderstorm
-    200, 201, 202, 210, 211, 212, 221, 230, 231, 232
-}
-
+    label = age_label(series)
+    return f"{forecast_text}\n\n{label}" if label else forecast_text
 
-async def check_for_precipitation_in_forecast(city: str,
-                                              min_lead_minutes: int = 30,
-                                              max_lead_minutes: int = 120):
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang=ru"
+async def get_forecast_series(city: str, city_id: int | None = None) -> ForecastSeries | None:
+    """Разобранный прогноз города (из кэша или OpenWeather); None, если получить его не удалось."""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-    except requests.RequestException as e:
-        print(f"ERROR (check_for_precipitation_in_forecast): Ошибка получения прогноза для {city}: {e}")
+        series = await _cached_fetch("forecast", _location_query(city, city_id))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"get_forecast_series: can't get forecast for {city}: {e}")
         return None
 
-    if str(data.get("cod")) != "200":
-        # logger.warning(f"API error for {city}: {data.get('message')}")
-        print(f"DEBUG (check_for_precipitation_in_forecast): API error for {city}: {data.get('message')}")
+    if not isinstance(series, ForecastSeries):
+        logger.warning(f"get_forecast_series: API error for {city}: {series.get('message')}")
         return None
-
-    city_timezone_offset_seconds = data.get("city", {}).get("timezone")
-    current_utc_time = datetime.datetime.now(pytz.utc)
-
-    intervals_to_check = ((max_lead_minutes // 60) + 2) // 3 + 1
-    if intervals_to_check < 2:  # Минимум 2 интервала (6 часов прогноза), чтобы было из чего выбирать
-        intervals_to_check = 2
-
-    first_relevant_precipitation = None  # Будем хранить здесь первое подходящее предупреждение
-
-    for forecast_item in data.get("list", [])[:intervals_to_check]:
-        weather_id = forecast_item.get("weather", [{}])[0].get("id")
-        if weather_id in PRECIPITATION_CODES:
-            description = forecast_item.get("weather", [{}])[0].get("description", "осадки")
-            dt_txt_utc_str = forecast_item.get("dt_txt", "")
-
-            try:
-                forecast_utc_time = pytz.utc.localize(datetime.datetime.strptime(dt_txt_utc_str, "%Y-%m-%d %H:%M:%S"))
-
-                time_difference_minutes = (forecast_utc_time - current_utc_time).total_seconds() / 60.0
-
-                # Условие: осадки в будущем, не ранее min_lead_minutes и не позднее max_lead_minutes
-                if min_lead_minutes <= time_difference_minutes <= max_lead_minutes:
-                    local_time_str = forecast_utc_time.strftime('%H:%M')  # По умолчанию UTC
-                    if city_timezone_offset_seconds is not None:
-                        city_tz = datetime.timezone(datetime.timedelta(seconds=city_timezone_offset_seconds))
-                        local_time = forecast_utc_time.astimezone(city_tz)
-                        local_time_str = local_time.strftime('%H:%M')
-
-                    # Сохраняем это как кандидата и выходим из цикла, так как мы ищем *первое* подходящее
-                    first_relevant_precipitation = f"Ожидаются осадки ({description}) примерно в {local_time_str} по местному времени (через ~{int(time_difference_minutes // 60)} ч {int(time_difference_minutes % 60)} мин)."
-                    break  # Нашли первое подходящее, дальше не ищем
-                # else:
-                # print(f"DEBUG: Precipitation for {city} at {forecast_utc_time} is outside desired window ({min_lead_minutes}-{max_lead_minutes} min). Diff: {time_difference_minutes:.0f} min")
-            except ValueError:
-                print(
-                    f"WARNING (check_for_precipitation_in_forecast): Could not parse forecast time {dt_txt_utc_str} for {city}")
-                continue
-
-    return first_relevant_precipitation
\ No newline at end of file
+    return series